@@ -18,13 +18,27 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import csv
+import json
 import os
+import time
+
+import requests
 
 from datetime import datetime
 from gql import gql, Client
+from graphql.execution import ExecutionResult
 
-from bolt_utils.bolt_transport import WrappedTransport
+from bolt_utils.bolt_transport import WrappedTransport, RawJSON
 from bolt_utils.bolt_logger import setup_custom_logger, log_time_execution
+from bolt_utils.bolt_circuit_breaker import backoff_delay
+from bolt_utils.bolt_exceptions import CircuitOpenError
+from bolt_utils.bolt_write_scheduler import WriteScheduler
+from bolt_utils.bolt_coalescer import OperationCoalescer
+from bolt_utils.bolt_archive import ResultsArchive
+from bolt_utils.bolt_chunking import ChunkSizer, GRAPHQL_MAX_PAYLOAD_BYTES, split, upload_chunks
+from bolt_utils.bolt_aggregation import histogram_percentiles
+from bolt_utils.bolt_quantiles import DISTRIBUTION_PERCENTILES, PERCENTILES, percentile_column
+from bolt_utils.bolt_payload_builder import RequestsPayloadBuilder, identifier
 
 # TODO: temporary solution for disabling warnings
 import urllib3
@@ -34,12 +48,28 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 # envs
 GRAPHQL_URL = os.getenv('BOLT_GRAPHQL_URL')
 HASURA_TOKEN = os.getenv('BOLT_HASURA_TOKEN')
+GRAPHQL_TIMEOUT = int(os.getenv('BOLT_GRAPHQL_TIMEOUT', '30'))
+# rows of ticks get idempotency keys, so retried tick is not inserted twice. Requires unique `idempotency_key`
+# columns (constraints `<table>_idempotency_key_key`) in execution_requests, execution_errors and execution_metrics_data
+IDEMPOTENT_WRITES = os.getenv('BOLT_IDEMPOTENT_WRITES', 'false').lower() in ('1', 'true', 'yes')
+# how long final writes at the end of test wait for API which is not available
+FINAL_WRITES_TIMEOUT = int(os.getenv('BOLT_FINAL_WRITES_TIMEOUT', '120'))
 
 logger = setup_custom_logger(__name__)
 
+# keys of tick stats uploaded as single execution_metrics_data row
+WRAPPER_METRICS = (
+    'worker_resources', 'loop_lag', 'instrumentation', 'worker_instrumentation', 'write_queues', 'circuit_breaker',
+    'latency_percentiles', 'slowest_requests', 'event_sampling', 'transport_traffic', 'coalesced_writes',
+)
+
 
-def identifier(parts: list):
-    return str(abs(hash(' '.join(map(lambda x: x.strip(), parts)).lower())))
+def insert_tick_rows(table, variable):
+    """
+    Insert field of tick rows, rows which are already inserted are skipped with idempotent writes
+    """
+    on_conflict = f', on_conflict: {{constraint: {table}_idempotency_key_key, update_columns: []}}'
+    return f'insert_{table}(objects: ${variable}{on_conflict if IDEMPOTENT_WRITES else ""}) {{ affected_rows }}'
 
 
 class BoltAPIClient(object):
@@ -53,9 +83,66 @@ class BoltAPIClient(object):
                 no_keep_alive=no_keep_alive,
                 url=GRAPHQL_URL,
                 use_json=True,
+                timeout=GRAPHQL_TIMEOUT,
                 headers={'Authorization': f'Bearer {HASURA_TOKEN}'},
             )
         )
+        self.coalescer = self.gql_client.transport.coalescer = OperationCoalescer(self.gql_client.transport)
+        self.write_scheduler = WriteScheduler(coalescer=self.coalescer)
+        self.chunk_sizer = ChunkSizer()
+        self.archive = self.gql_client.transport.archive = ResultsArchive()
+        if self.archive.offline:
+            logger.warning(f'Offline mode, results are archived in {self.archive.path}')
+
+    def schedule_write(self, lane, func, *args, **kwargs):
+        """
+        Execute write `func` in background by priority of lane (see WriteScheduler.submit)
+        """
+        self.write_scheduler.submit(lane, func, *args, **kwargs)
+
+    def flush_writes(self):
+        if not self.write_scheduler.flush():
+            logger.warning(f'Not all scheduled writes were sent. Pending: {self.write_scheduler.depths()}')
+
+    def wait_for_api(self, attempt, deadline):
+        """
+        Sleep before next attempt of write, until circuit breaker allows calls and at least for backoff delay.
+        Returns False if deadline (time.monotonic) passed.
+        """
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        circuit_breaker = self.gql_client.transport.circuit_breaker
+        time.sleep(min(remaining, max(circuit_breaker.open_time_left(), backoff_delay(attempt))))
+        return True
+
+    def write_until_available(self, deadline, func, *args, **kwargs):
+        """
+        Execute write `func` now and retry it while API is not available, until deadline (time.monotonic).
+        Returns False if write was not executed.
+        """
+        attempt = 0
+        while True:
+            try:
+                func(*args, **kwargs)
+                return True
+            except (CircuitOpenError, requests.RequestException) as ex:
+                if not self.wait_for_api(attempt, deadline):
+                    logger.error(f'Write {func.__name__} was not executed, API is not available | {ex}')
+                    return False
+                attempt += 1
+
+    def write_or_archive(self, deadline, func, *args, **kwargs):
+        """
+        Execute write of results as `write_until_available`, results which were not written until deadline are
+        archived (when archiving on outage is enabled). Returns False if results were neither written nor archived.
+        """
+        if self.write_until_available(deadline, func, *args, **kwargs):
+            return True
+        if not self.archive.start_outage_archiving():
+            return False
+        func(*args, **kwargs)
+        return True
 
     @log_time_execution(logger)
     def get_execution(self, execution_id):
@@ -113,50 +200,44 @@ class BoltAPIClient(object):
 
     @log_time_execution(logger)
     def insert_requests_distribution_results(self, stats):
+        # stats are not modified (except 'metrics_uploaded' flag), rows are built in new variables
         ts = datetime.now().isoformat()
-        request_tick_stats = stats.pop("requests", {})
-        stats['requests'] = []
-
-        median_response_time = stats.pop("median_response_time_per_endpoint", {})
-        avg_requests_per_second = stats.pop("avg_req_per_sec_per_endpoint", {})
-
-        for request in request_tick_stats:
-            for endpoint in request.get('stats', []):
-                req_id = identifier([endpoint['method'], endpoint['name']])
-                successes = endpoint['num_requests'] - (endpoint['num_failures'] + endpoint['num_none_requests'])
-                stats['requests'].append({
-                    'timestamp': ts,
-                    'identifier': req_id,
-                    'method': endpoint['method'],
-                    'name': endpoint['name'],
-                    'num_requests': endpoint['num_requests'],
-                    'num_failures': endpoint['num_failures'],
-                    'average_response_time': stats['average_response_time'],
-                    'min_response_time': endpoint['min_response_time'],
-                    'max_response_time': endpoint['max_response_time'],
-                    'average_content_size': stats['average_response_size'],
-                    'total_content_length': endpoint['total_content_length'],
-                    'median_response_time': median_response_time.get(endpoint['name'], 0),
-                    'requests_per_second': avg_requests_per_second.get(endpoint['name'], 0),
-                    'successes_per_tick': successes,
-                })
-
-        stats['errors'] = []
-        for ed in stats.pop('error_details', []):
-            ed_id = identifier([ed['method'], ed['name']])
-            stats['errors'].append({
+        # every row gets deterministic key (execution, tick index, row), so retried tick is not inserted twice
+        tick_key = [str(stats.get('execution_id')), str(stats.get('tick', stats.get('timestamp')))]
+        if not IDEMPOTENT_WRITES:
+            tick_key = None
+
+        requests_payload = RequestsPayloadBuilder(tick_key, ts, stats.get('average_response_size', 0))
+        median_response_time = stats.get('median_response_time_per_endpoint', {})
+        avg_requests_per_second = stats.get('avg_req_per_sec_per_endpoint', {})
+        for request in stats.get('requests', ()):
+            requests_payload.add_endpoints(request.get('stats', ()), median_response_time, avg_requests_per_second)
+
+        metrics = []
+        metrics_data = {key: stats[key] for key in WRAPPER_METRICS if stats.get(key)}
+        if metrics_data and not stats.get('metrics_uploaded'):
+            metrics.append({'timestamp': ts, 'data': metrics_data})
+            if tick_key is not None:
+                metrics[0]['idempotency_key'] = identifier([*tick_key, 'metrics'])
+
+        errors = []
+        for ed in stats.get('error_details', ()):
+            errors.append({
                 'timestamp': ts,
-                'identifier': ed_id,
+                'identifier': identifier([ed['method'], ed['name']]),
                 'method': ed['method'],
                 'name': ed['name'],
                 'exception_data': ed['error'],
                 'number_of_occurrences': ed['occurrences'],
             })
+            if tick_key is not None:
+                errors[-1]['idempotency_key'] = identifier([*tick_key, 'errors', str(len(errors) - 1)])
 
         query = gql('''
             mutation (
                 $requests:[execution_requests_insert_input!]!, 
                 $errors:[execution_errors_insert_input!]!,
+                $metrics:[execution_metrics_data_insert_input!]!,
                 $timestamp: timestamptz, 
                 $number_of_successes: Int, 
                 $number_of_fails: Int, 
@@ -165,54 +246,80 @@ class BoltAPIClient(object):
                 $average_response_time: numeric, 
                 $average_response_size: numeric
             ){ 
-                insert_execution_requests(objects: $requests) { affected_rows }
-                insert_execution_errors(objects: $errors) { affected_rows }
+                %s
+                %s
+                %s
             }
-        ''')
-        #  hack for avoid unexpected value during gql sending
-        # TODO set this values only for proper cases
-        stats.pop('timestamp', None)
-        stats.pop('number_of_successes', None)
-        stats.pop('number_of_fails', None)
-        stats.pop('number_of_errors', None)
-        stats.pop('number_of_users', None)
-        stats.pop('average_response_time', None)
-        stats.pop('average_response_size', None)
-        if 'execution_id' in stats:
-            del stats['execution_id']
-        result = self.gql_client.transport.execute(query, variable_values=stats)
-        return result
+        ''' % (
+            insert_tick_rows('execution_requests', 'requests'),
+            insert_tick_rows('execution_errors', 'errors'),
+            insert_tick_rows('execution_metrics_data', 'metrics'),
+        ))
+        requests_rows = requests_payload.encoded_rows()
+        payload_bytes = sum(map(len, requests_rows)) + len(json.dumps(errors)) + len(json.dumps(metrics))
+        # retried tick which was uploaded in chunks is split again in the same way
+        if payload_bytes <= GRAPHQL_MAX_PAYLOAD_BYTES and 'chunk_rows' not in stats:
+            variable_values = {
+                'requests': RawJSON('[' + ','.join(requests_rows) + ']'), 'errors': errors, 'metrics': metrics
+            }
+            result = self.gql_client.transport.execute(query, variable_values=variable_values)
+            return result
+
+        # oversized tick is uploaded in chunks, chunk size and uploaded chunks are kept in stats, so only chunks which
+        # were not uploaded are sent again when tick is retried (rows are not duplicated without idempotent writes)
+        chunk_rows = stats.setdefault(
+            'chunk_rows', self.chunk_sizer.chunk_rows(payload_bytes // (len(requests_rows) + len(errors) or 1))
+        )
+        uploaded_chunks = stats.setdefault('uploaded_chunks', set())
+        chunks = [
+            {'requests': RawJSON('[' + ','.join(rows) + ']'), 'errors': [], 'metrics': []}
+            for rows in split(requests_rows, chunk_rows)
+        ] + [
+            {'requests': RawJSON('[]'), 'errors': rows, 'metrics': []} for rows in split(errors, chunk_rows)
+        ] or [{'requests': RawJSON('[]'), 'errors': [], 'metrics': []}]
+        chunks[0]['metrics'] = metrics
+
+        def send(index):
+            result = self.gql_client.transport.execute(query, variable_values=chunks[index])
+            if not result.errors:
+                uploaded_chunks.add(index)
+                if chunks[index]['metrics']:
+                    # metrics row is not built again when tick is retried
+                    stats['metrics_uploaded'] = True
+            return result
+
+        pending = [index for index in range(len(chunks)) if index not in uploaded_chunks]
+        logger.info(f'Payload of {payload_bytes} bytes split into {len(chunks)} chunks of {chunk_rows} rows, '
+                    f'sending {len(pending)} of them')
+        results = upload_chunks(send, pending, self.chunk_sizer)
+        # archived chunks (offline mode) have no data
+        return ExecutionResult(data={
+            key: {'affected_rows': sum(result.data[key]['affected_rows'] for result in results if result.data)}
+            for key in (results[0].data if results else None) or ()
+        })
 
     @log_time_execution(logger)
     def insert_endpoint_totals(self, execution_id, stats):
-        query = gql('''
-            query ($eid:uuid!) {
-                execution_by_pk(id:$eid) {
-                    execution_requests (
-                      distinct_on: [identifier]
-                      order_by: [{identifier: asc}, {timestamp: desc}]
-                    ) 
-                    {
-                      execution_id, identifier, method, name, timestamp
-                    }
-                  }
-                }
-        ''')
-        result = self.gql_client.transport.execute(query, variable_values={'eid': execution_id})
-        ep_stats = result.formatted["data"]["execution_by_pk"]["execution_requests"]
-        for el in ep_stats:
-            singular_ep_stats = stats.get(el["name"], el["method"])
-            el["num_requests"] = singular_ep_stats.num_requests
-            el["num_failures"] = singular_ep_stats.num_failures
-            el["median_response_time"] = round(singular_ep_stats.median_response_time)
-            el["average_response_time"] = round(singular_ep_stats.avg_response_time)
-            el["min_response_time"] = round(singular_ep_stats.min_response_time)
-            el["max_response_time"] = round(singular_ep_stats.max_response_time)
-            el["average_content_size"] = round(singular_ep_stats.avg_content_length)
-            el["requests_per_second"] = round(singular_ep_stats.total_rps)
+        # totals are built from master stats only, with the same identifiers as in execution_requests
+        ts = datetime.now().isoformat()
+        ep_stats = [{
+            'execution_id': execution_id,
+            'identifier': identifier([e.method, e.name]),
+            'method': e.method,
+            'name': e.name,
+            'timestamp': ts,
+            'num_requests': e.num_requests,
+            'num_failures': e.num_failures,
+            'median_response_time': round(e.median_response_time),
+            'average_response_time': round(e.avg_response_time),
+            'min_response_time': round(e.min_response_time or 0),
+            'max_response_time': round(e.max_response_time),
+            'average_content_size': round(e.avg_content_length),
+            'requests_per_second': round(e.total_rps),
             # locust does not provide min/max content length for singular endpoint in final stats
-            el["min_content_size"] = 0
-            el["max_content_size"] = 0
+            'min_content_size': 0,
+            'max_content_size': 0,
+        } for e in stats.entries.values()]
 
         mutation = gql('''
             mutation ($data:[execution_request_totals_insert_input!]!) {
@@ -231,17 +338,31 @@ class BoltAPIClient(object):
         result = self.gql_client.transport.execute(mutation, variable_values={'data': ep_stats})
         return result
 
-    @log_time_execution(logger)
-    def insert_time_distribution_results(self, execution_id, stats):
-        percentiles = [50, 66, 75, 80, 90, 95, 98, 99, 100]
-        distributions = [{
-            'timestamp': datetime.now().isoformat(),
+    @staticmethod
+    def distribution_rows(stats, ts, percentiles=PERCENTILES):
+        entries = list(stats.entries.values())
+        # percentiles of all endpoints at once (vectorized with NumPy backend)
+        percentiles = histogram_percentiles(
+            [e.response_times for e in entries], [e.num_requests for e in entries], percentiles
+        )
+        return [{
+            'timestamp': ts,
             'identifier': identifier([e.method, e.name]),
             'method': e.method,
             'name': e.name,
             'num_requests': e.num_requests,
-            **{f'p{percent}': e.get_response_time_percentile(percent / 100) for percent in percentiles}
-        } for e in stats.entries.values()]
+            **{percentile_column(percent): value for percent, value in endpoint_percentiles.items()}
+        } for e, endpoint_percentiles in zip(entries, percentiles)]
+
+    @log_time_execution(logger)
+    def insert_time_distribution_results(self, execution_id, stats):
+        # final distribution, execution_distribution has single row per endpoint and columns only for some percentiles
+        percentiles = [percent for percent in PERCENTILES if percent in DISTRIBUTION_PERCENTILES]
+        if len(percentiles) < len(PERCENTILES):
+            logger.warning(f'Percentiles {[p for p in PERCENTILES if p not in DISTRIBUTION_PERCENTILES]} have no '
+                           f'columns in execution_distribution, they are saved in final distribution snapshot')
+            self.insert_distribution_snapshot(execution_id, stats)
+        distributions = self.distribution_rows(stats, datetime.now().isoformat(), percentiles)
 
         query = gql('''
                     mutation (
@@ -253,6 +374,16 @@ class BoltAPIClient(object):
         result = self.gql_client.transport.execute(query, variable_values={'distributions': distributions})
         return result
 
+    def insert_distribution_snapshot(self, execution_id, stats):
+        """
+        Distribution during test is saved as execution_metrics_data row, so execution_distribution keeps
+        only final rows
+        """
+        ts = datetime.now().isoformat()
+        return self.insert_execution_metrics_data({
+            'timestamp': ts, 'data': {'distribution_snapshot': self.distribution_rows(stats, ts)}
+        })
+
     @log_time_execution(logger)
     def insert_error_results(self, error_objects):
         query = gql('''
@@ -358,6 +489,10 @@ class BoltAPIClient(object):
 
     def terminate(self):
         logger.info('Terminating GQL Client')
+        if self.archive.archived:
+            logger.warning(f'{self.archive.archived} operations were archived in {self.archive.path}. '
+                           f'Upload them with `python -m bolt_run upload_archive`')
+        self.archive.close()
         try:
             self.gql_client.close()
         except AttributeError:
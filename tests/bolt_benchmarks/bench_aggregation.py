@@ -0,0 +1,118 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of aggregation backends: pure Python against NumPy for quantiles of sampled requests and per endpoint
+histogram medians and percentiles, for growing number of values. Prints time of both backends and the smallest
+size from which NumPy is faster (crossover), to be used as BOLT_NUMPY_MIN_VALUES (quantiles) and
+BOLT_NUMPY_MIN_BUCKETS (histograms). Results of both backends are compared (with types of values) before timing,
+so crossover is only reported for equivalent backends. Run from `tests` directory:
+
+    python -m bolt_benchmarks.bench_aggregation
+"""
+
+import random
+import sys
+import time
+from array import array
+
+from bolt_utils.bolt_aggregation import NumpyAggregation, PythonAggregation, numpy
+from bolt_utils.bolt_quantiles import PERCENTILES
+
+# number of values (sampled requests or buckets of all histograms)
+SIZES = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 1000000)
+# buckets of single endpoint histogram
+HISTOGRAM_WIDTH = 50
+QUANTILES = [0.49, 0.5, 0.51, 0.89, 0.9, 0.91, 0.98, 0.99, 1.0]
+MIN_TIME = 0.2
+
+
+def sampled_response_times(rng, size):
+    return array('d', (rng.lognormvariate(4, 0.6) for _ in range(size)))
+
+
+def histograms(rng, size):
+    endpoints = max(1, size // HISTOGRAM_WIDTH)
+    width = min(size, HISTOGRAM_WIDTH)
+    result = []
+    for _ in range(endpoints):
+        response_times = {}
+        while len(response_times) < width:
+            response_times[int(rng.lognormvariate(4, 0.8))] = rng.randint(1, 100)
+        result.append(response_times)
+    return result
+
+
+def benchmarks(rng, size):
+    response_times = sampled_response_times(rng, size)
+    endpoint_histograms = histograms(rng, size)
+    totals = [sum(histogram.values()) for histogram in endpoint_histograms]
+    return {
+        'quantiles': lambda backend: backend.quantiles(response_times, QUANTILES),
+        'histogram_medians': lambda backend: backend.histogram_medians(endpoint_histograms),
+        'histogram_percentiles': lambda backend: backend.histogram_percentiles(
+            endpoint_histograms, totals, PERCENTILES
+        ),
+    }
+
+
+def check_same_results(name, size, func):
+    python_result, numpy_result = func(PythonAggregation), func(NumpyAggregation)
+    # repr also compares types of values (5 and 5.0 are equal, but reported differently)
+    if repr(python_result) != repr(numpy_result):
+        raise AssertionError(
+            f'{name} ({size} values) differs between backends: {python_result!r} != {numpy_result!r}'
+        )
+
+
+def measure(func):
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_TIME:
+            return elapsed / number
+        number *= 2 if elapsed > MIN_TIME / 10 else 10
+
+
+def main():
+    if numpy is None:
+        print('NumPy is not installed, only pure Python backend is available')
+        sys.exit(1)
+    rng = random.Random(0)
+    crossover = {}
+    print(f'{"benchmark":>22} {"size":>8} {"python ms":>10} {"numpy ms":>10} {"speedup":>8}')
+    for size in SIZES:
+        for name, func in benchmarks(rng, size).items():
+            check_same_results(name, size, func)
+            python_ms = measure(lambda: func(PythonAggregation)) * 1000
+            numpy_ms = measure(lambda: func(NumpyAggregation)) * 1000
+            if numpy_ms < python_ms:
+                crossover.setdefault(name, size)
+            else:
+                crossover.pop(name, None)
+            print(f'{name:>22} {size:>8} {python_ms:>10.3f} {numpy_ms:>10.3f} {python_ms / numpy_ms:>7.2f}x')
+    for name in ('quantiles', 'histogram_medians', 'histogram_percentiles'):
+        print(f'Crossover of {name}: {crossover.get(name, "not reached")}')
+
+
+if __name__ == '__main__':
+    main()
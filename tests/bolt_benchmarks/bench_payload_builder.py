@@ -0,0 +1,122 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of per tick execution_requests payload: rows built as dicts and encoded with default `json.dumps`
+(previous implementation) against `RequestsPayloadBuilder`. Run from `tests` directory:
+
+    python -m bolt_benchmarks.bench_payload_builder
+"""
+
+import json
+import time
+import tracemalloc
+
+from bolt_utils.bolt_payload_builder import RequestsPayloadBuilder, identifier
+from bolt_utils.bolt_transport import encode_payload
+
+ENDPOINTS = (10, 100, 1000)
+WORKERS = 4
+TICKS = 50
+
+
+def worker_report(endpoints):
+    return {'stats': [{
+        'method': 'GET', 'name': f'/api/v1/resource/{i}', 'num_requests': 100 + i, 'num_failures': i % 3,
+        'num_none_requests': 0, 'total_response_time': 1234.5 * (i + 1), 'min_response_time': 1.25,
+        'max_response_time': 250.5, 'total_content_length': 4096 * (i + 1),
+    } for i in range(endpoints)]}
+
+
+def tick_stats(endpoints):
+    names = [f'/api/v1/resource/{i}' for i in range(endpoints)]
+    return {
+        'execution_id': '00000000-0000-0000-0000-000000000000', 'tick': 1700000000,
+        'requests': [worker_report(endpoints) for _ in range(WORKERS)],
+        'median_response_time_per_endpoint': {name: 12.5 for name in names},
+        'avg_req_per_sec_per_endpoint': {name: 40 for name in names},
+        'average_response_size': 4096,
+    }
+
+
+def dict_rows(stats, ts):
+    tick_key = [str(stats['execution_id']), str(stats['tick'])]
+    rows = []
+    for request in stats['requests']:
+        for endpoint in request['stats']:
+            rows.append({
+                'timestamp': ts,
+                'identifier': identifier([endpoint['method'], endpoint['name']]),
+                'idempotency_key': identifier([*tick_key, 'requests', str(len(rows))]),
+                'method': endpoint['method'],
+                'name': endpoint['name'],
+                'num_requests': endpoint['num_requests'],
+                'num_failures': endpoint['num_failures'],
+                'average_response_time': round(
+                    endpoint['total_response_time'] / endpoint['num_requests']
+                ) if endpoint['num_requests'] else 0,
+                'min_response_time': endpoint['min_response_time'],
+                'max_response_time': endpoint['max_response_time'],
+                'average_content_size': stats['average_response_size'],
+                'total_content_length': endpoint['total_content_length'],
+                'median_response_time': stats['median_response_time_per_endpoint'].get(endpoint['name'], 0),
+                'requests_per_second': stats['avg_req_per_sec_per_endpoint'].get(endpoint['name'], 0),
+                'successes_per_tick': endpoint['num_requests'] - (
+                    endpoint['num_failures'] + endpoint['num_none_requests']
+                ),
+            })
+    return json.dumps({'query': '', 'variables': {'requests': rows}}).encode('utf-8')
+
+
+def columnar_rows(stats, ts):
+    tick_key = [str(stats['execution_id']), str(stats['tick'])]
+    builder = RequestsPayloadBuilder(tick_key, ts, stats['average_response_size'])
+    for request in stats['requests']:
+        builder.add_endpoints(
+            request['stats'], stats['median_response_time_per_endpoint'], stats['avg_req_per_sec_per_endpoint']
+        )
+    return encode_payload({'query': '', 'variables': {'requests': builder.to_json()}}).encode('utf-8')
+
+
+def measure(func, stats):
+    ts = '2023-01-01T00:00:00'
+    # CPU per tick
+    started = time.process_time()
+    for _ in range(TICKS):
+        body = func(stats, ts)
+    cpu_ms = (time.process_time() - started) * 1000 / TICKS
+    # memory allocated at once during single tick
+    tracemalloc.start()
+    func(stats, ts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak, len(body)
+
+
+def main():
+    print(f'{"endpoints":>9} {"builder":>8} {"cpu ms/tick":>12} {"peak KiB":>9} {"body KiB":>9}')
+    for endpoints in ENDPOINTS:
+        stats = tick_stats(endpoints)
+        for name, func in (('dict', dict_rows), ('columnar', columnar_rows)):
+            cpu_ms, peak, size = measure(func, stats)
+            print(f'{endpoints:>9} {name:>8} {cpu_ms:>12.3f} {peak / 1024:>9.1f} {size / 1024:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
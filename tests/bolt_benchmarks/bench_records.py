@@ -0,0 +1,117 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of requests kept for interval and error entries: dict built for every request (previous
+implementation) against columns of `EventSample` keeping every request and `ErrorRecord`, and against `EventSample`
+without sampling (default, only counters). Measures time of counting requests of one interval, memory kept by them and
+duration of full garbage collection while they are alive. Run from `tests` directory:
+
+    python -m bolt_benchmarks.bench_records
+"""
+
+import gc
+import random
+import time
+import tracemalloc
+
+from bolt_utils.bolt_error_aggregator import ErrorAggregator, ErrorRecord, error_key
+from bolt_utils.bolt_event_sampling import EventSample
+
+REQUESTS = (10000, 100000, 1000000)
+ENDPOINTS = 100
+ERROR_RATE = 0.05
+EXECUTION_ID = '00000000-0000-0000-0000-000000000000'
+
+
+def requests(count):
+    rng = random.Random(count)
+    names = [f'/api/v1/resource/{i}' for i in range(ENDPOINTS)]
+    return [
+        ('GET', rng.choice(names), rng.lognormvariate(4, 0.6), 2048,
+         Exception(f'HTTPError({rng.choice((500, 502, 503))})') if rng.random() < ERROR_RATE else None)
+        for _ in range(count)
+    ]
+
+
+def dict_records(sample):
+    events = []
+    errors = ErrorAggregator(formatter=dict)
+    for request_type, name, response_time, response_length, exception in sample:
+        if exception is not None:
+            combined_key = error_key(request_type, name, str(exception))
+            errors.add(combined_key, 1, lambda: {
+                'execution_id': EXECUTION_ID, 'name': name,
+                'error_type': request_type, 'exception_data': str(exception)
+            })
+        events.append({
+            'execution_id': EXECUTION_ID, 'endpoint': name, 'exception': str(exception),
+            'request_type': request_type, 'response_length': response_length, 'response_time': float(response_time),
+            'event_type': 'failure' if exception is not None else 'success', 'timestamp': int(time.time()),
+        })
+    return events, errors
+
+
+def column_records(sample, reservoir_size=None):
+    # reservoir of whole sample keeps every request in columns
+    events = EventSample(reservoir_size=len(sample) if reservoir_size is None else reservoir_size)
+    errors = ErrorAggregator()
+    for request_type, name, response_time, response_length, exception in sample:
+        if exception is not None:
+            exception = str(exception)
+            combined_key = error_key(request_type, name, exception)
+            errors.add(combined_key, 1, lambda: ErrorRecord(request_type, name, exception))
+        events.offer(request_type, name, float(response_time), response_length, exception, int(time.time()))
+    return events, errors
+
+
+def counter_records(sample):
+    return column_records(sample, reservoir_size=0)
+
+
+def measure(func, sample):
+    gc.collect()
+    started = time.process_time()
+    func(sample)
+    cpu_ms = (time.process_time() - started) * 1000
+    # memory kept by records of interval
+    gc.collect()
+    tracemalloc.start()
+    records = func(sample)
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # full collection has to traverse all tracked objects which are alive
+    started = time.perf_counter()
+    gc.collect()
+    gc_ms = (time.perf_counter() - started) * 1000
+    del records
+    return cpu_ms, kept, gc_ms
+
+
+def main():
+    print(f'{"requests":>9} {"records":>8} {"cpu ms":>9} {"kept MiB":>9} {"gc ms":>8}')
+    for count in REQUESTS:
+        sample = requests(count)
+        for name, func in (('dict', dict_records), ('columns', column_records), ('counters', counter_records)):
+            cpu_ms, kept, gc_ms = measure(func, sample)
+            print(f'{count:>9} {name:>8} {cpu_ms:>9.1f} {kept / 1024 / 1024:>9.1f} {gc_ms:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
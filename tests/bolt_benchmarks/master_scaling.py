@@ -0,0 +1,333 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Scaling benchmark of master: real locust `MasterRunner` with wrapper loaded receives reports and heartbeats from
+N simulated workers (greenlets with own RPC connection, in the same process). For every N it records master CPU,
+latency of report processing, late heartbeats and backlog of writes, so the scaling curve can be compared between
+releases. Every N is measured in a fresh process, because wrapper keeps its state in module globals. Writes go
+through the write scheduler to stub transport, which encodes them as for API and answers after `--api-latency-ms`
+without sending. Run from `tests` directory:
+
+    python -m bolt_benchmarks.master_scaling --workers 1,10,50,100 --duration 30 --output master_scaling.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import gevent
+
+# benchmark runs master of the wrapper against simulated workers
+os.environ.setdefault('BOLT_WORKER_TYPE', 'master')
+os.environ.setdefault('BOLT_EXECUTION_ID', 'master-scaling')
+os.environ.setdefault('BOLT_LOCUSTFILE_NAME', 'bolt_benchmarks.noop_locustfile')
+# writes are not sent (see StubTransport), but they must not be archived in offline mode
+os.environ['BOLT_GRAPHQL_URL'] = 'http://127.0.0.1/v1/graphql'
+os.environ['BOLT_OFFLINE'] = 'false'
+
+# CPU usage reported by simulated workers in heartbeats
+SIMULATED_CPU_USAGE = 10
+USERS_PER_WORKER = 10
+
+
+class SimulatedWorker(object):
+    """
+    Speaks worker side of locust RPC protocol: ready, heartbeats, spawn replies and stats reports built with
+    locust `RequestStats` (as real worker does), with latency sketches and slowest requests of the wrapper.
+    """
+    def __init__(self, index, port, endpoints, rps, error_rate, sent_reports):
+        from locust.rpc import rpc
+        from locust.stats import RequestStats
+
+        self.node_id = f'simulated_{index}'
+        self.client = rpc.Client('127.0.0.1', port, self.node_id)
+        self.stats = RequestStats()
+        self.endpoints = [f'/endpoint/{i}' for i in range(endpoints)]
+        self.rps = rps
+        self.error_rate = error_rate
+        self.sent_reports = sent_reports
+        self.user_classes_count = {}
+        self.state = 'ready'
+        self.random = random.Random(index)
+        # CPU spent on building reports, it is not part of master load
+        self.build_cpu_time = 0.0
+        self.greenlets = []
+
+    def start(self):
+        from locust import __version__
+        from locust.rpc import Message
+
+        self.client.send(Message('client_ready', __version__, self.node_id))
+        self.greenlets = [gevent.spawn(job) for job in (self.receive, self.heartbeat, self.report)]
+
+    def stop(self):
+        from locust.rpc import Message
+
+        gevent.killall(self.greenlets)
+        self.client.send(Message('quit', None, self.node_id))
+        self.client.close(linger=100)
+
+    def receive(self):
+        from locust.rpc import Message
+
+        while True:
+            msg = self.client.recv()
+            if msg.type == 'spawn':
+                self.user_classes_count = msg.data['user_classes_count']
+                self.state = 'running'
+                self.client.send(Message('spawning', None, self.node_id))
+                self.client.send(Message(
+                    'spawning_complete', {
+                        'user_classes_count': self.user_classes_count,
+                        'user_count': sum(self.user_classes_count.values())
+                    }, self.node_id
+                ))
+            elif msg.type in ('stop', 'quit'):
+                return
+
+    def heartbeat(self):
+        from locust.rpc import Message
+        from locust.runners import HEARTBEAT_INTERVAL
+
+        while True:
+            self.client.send(Message('heartbeat', {
+                'state': self.state, 'current_cpu_usage': SIMULATED_CPU_USAGE, 'current_memory_usage': 0
+            }, self.node_id))
+            gevent.sleep(HEARTBEAT_INTERVAL)
+
+    def build_report(self, interval):
+        from bolt_utils.bolt_latency_sketch import LatencySketch, serialize_sketches
+        from bolt_utils.bolt_slowest_requests import SlowestRequests
+
+        sketches = {}
+        slowest_requests = SlowestRequests()
+        for _ in range(int(self.rps * interval)):
+            name = self.random.choice(self.endpoints)
+            response_time = self.random.lognormvariate(4, 0.5)
+            self.stats.log_request('GET', name, response_time, 1024)
+            if self.random.random() < self.error_rate:
+                self.stats.log_error('GET', name, 'HTTPError(500)')
+            sketches.setdefault(('GET', name), LatencySketch()).add(response_time)
+            slowest_requests.add(('GET', name), response_time, lambda: {'response_time': response_time, 'url': name})
+        data = {
+            'stats': self.stats.serialize_stats(),
+            'stats_total': self.stats.total.get_stripped_report(),
+            'errors': self.stats.serialize_errors(),
+            'user_classes_count': self.user_classes_count,
+            'user_count': sum(self.user_classes_count.values()),
+            'latency_sketches': serialize_sketches(sketches),
+            'slowest_requests': slowest_requests.serialize(),
+        }
+        self.stats.errors = {}
+        return data
+
+    def report(self):
+        from locust.rpc import Message
+        from locust.runners import WORKER_REPORT_INTERVAL
+
+        # workers do not report at the same moment
+        gevent.sleep(self.random.uniform(0, WORKER_REPORT_INTERVAL))
+        while True:
+            started = time.process_time()
+            message = Message('stats', self.build_report(WORKER_REPORT_INTERVAL), self.node_id)
+            self.build_cpu_time += time.process_time() - started
+            self.sent_reports[self.node_id].append(time.perf_counter())
+            self.client.send(message)
+            gevent.sleep(WORKER_REPORT_INTERVAL)
+
+
+def stub_transport(latency):
+    """
+    Transport which encodes payload as for API, but does not send it and answers after `latency` seconds
+    """
+    from bolt_utils.bolt_transport import WrappedTransport
+
+    class StubTransport(WrappedTransport):
+        def post(self, post_args):
+            time.sleep(latency)
+            return {'data': {}}
+
+    return StubTransport(url=os.environ['BOLT_GRAPHQL_URL'], use_json=True, headers={})
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        'p50_ms': round(values[len(values) // 2] * 1000, 3),
+        'p99_ms': round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+    }
+
+
+def run_single(workers, duration, warmup, endpoints, rps, error_rate, api_latency):
+    """
+    Measure master with `workers` simulated workers, must be called in fresh process
+    """
+    from locust import events
+    from locust.argument_parser import parse_options
+    from locust.env import Environment
+    from locust.runners import HEARTBEAT_LIVENESS, STATE_MISSING
+
+    import bolt_locust_wrapper
+    from bolt_benchmarks.noop_locustfile import NoopUser
+    from bolt_utils import bolt_instrumentation
+
+    wrapper = bolt_locust_wrapper.locust_wrapper
+    api_client = wrapper.bolt_api_client
+    transport = stub_transport(api_latency)
+    transport.archive, transport.coalescer = api_client.archive, api_client.coalescer
+    api_client.gql_client.transport = api_client.coalescer.transport = transport
+    options = parse_options(args=[
+        '-f', 'bolt_locust_wrapper.py', '--master', '--headless', '--expect-workers', str(workers),
+    ])
+    environment = Environment(user_classes=[NoopUser], events=events, parsed_options=options)
+    runner = environment.create_master_runner('127.0.0.1', 0)
+    events.init.fire(environment=environment, runner=runner, web_ui=None)
+
+    sent_reports = collections.defaultdict(collections.deque)
+    report_lags = []
+    measuring = False
+
+    def report_lag(client_id, data):
+        # listener is added after wrapper's, lag covers queueing in master and processing by wrapper
+        sent_at = sent_reports[client_id].popleft()
+        if measuring:
+            report_lags.append(time.perf_counter() - sent_at)
+    events.worker_report.add_listener(report_lag)
+
+    simulated = [
+        SimulatedWorker(i, runner.server.port, endpoints, rps, error_rate, sent_reports) for i in range(workers)
+    ]
+    for worker in simulated:
+        worker.start()
+    while len(runner.clients.all) < workers:
+        gevent.sleep(0.1)
+    gevent.spawn(runner.start, USERS_PER_WORKER * workers, USERS_PER_WORKER * workers)
+    gevent.sleep(warmup)
+
+    measuring = True
+    counters = bolt_instrumentation.snapshot()
+    build_cpu_time = sum(worker.build_cpu_time for worker in simulated)
+    cpu_time = time.process_time()
+    started = time.perf_counter()
+    late_heartbeats = 0
+    missing_workers = set()
+    max_backlog = {'write_queues': 0, 'stats_queue': 0, 'dataset': 0}
+    while time.perf_counter() - started < duration:
+        gevent.sleep(1)
+        for client in runner.clients.all:
+            # heartbeat is reset to HEARTBEAT_LIVENESS on every heartbeat and decremented by master every second
+            if client.heartbeat < HEARTBEAT_LIVENESS - 1:
+                late_heartbeats += 1
+            if client.state == STATE_MISSING:
+                missing_workers.add(client.id)
+        depths = api_client.write_scheduler.depths()
+        for key, value in (
+            ('write_queues', sum(lane['depth'] for lane in depths.values())),
+            ('stats_queue', len(wrapper.stats_queue)),
+            ('dataset', len(wrapper.dataset)),
+        ):
+            max_backlog[key] = max(max_backlog[key], value)
+    elapsed = time.perf_counter() - started
+    master_cpu_time = time.process_time() - cpu_time - (
+        sum(worker.build_cpu_time for worker in simulated) - build_cpu_time
+    )
+    measuring = False
+    result = {
+        'workers': workers,
+        'duration': round(elapsed, 3),
+        'master_cpu_percent': round(master_cpu_time / elapsed * 100, 2),
+        'reports': len(report_lags),
+        'report_lag': _percentiles(report_lags),
+        'instrumentation': bolt_instrumentation.summary_since(counters),
+        'late_heartbeats': late_heartbeats,
+        'missing_workers': len(missing_workers),
+        'max_backlog': max_backlog,
+        'shed_writes': sum(lane['shed'] for lane in api_client.write_scheduler.depths().values()),
+    }
+
+    for worker in simulated:
+        worker.stop()
+    runner.quit()
+    events.quit.fire(exit_code=0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,5,10,25,50', help='comma separated numbers of simulated workers')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds for every number of workers')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before measurement starts')
+    parser.add_argument('--endpoints', type=int, default=20, help='endpoints in every report')
+    parser.add_argument('--rps', type=float, default=100, help='requests per second of every simulated worker')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of failed requests')
+    parser.add_argument('--api-latency-ms', type=float, default=50, help='latency of every write to stub API')
+    parser.add_argument('--output', help='file for results (JSON)')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        result = run_single(
+            int(args.workers), args.duration, args.warmup, args.endpoints, args.rps, args.error_rate,
+            args.api_latency_ms / 1000
+        )
+        print(json.dumps(result))
+        return
+
+    from locust import __version__
+
+    results = []
+    for workers in [int(value) for value in args.workers.split(',')]:
+        output = subprocess.run(
+            [sys.executable, '-m', 'bolt_benchmarks.master_scaling', '--single', '--workers', str(workers),
+             '--duration', str(args.duration), '--warmup', str(args.warmup), '--endpoints', str(args.endpoints),
+             '--rps', str(args.rps), '--error-rate', str(args.error_rate),
+             '--api-latency-ms', str(args.api_latency_ms)],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f'{workers:>5} workers: master CPU {result["master_cpu_percent"]:>6}%, '
+              f'report lag p99 {result["report_lag"].get("p99_ms")}ms, '
+              f'late heartbeats {result["late_heartbeats"]}, max write backlog {result["max_backlog"]["write_queues"]}')
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'locust': __version__,
+                'parameters': {
+                    'duration': args.duration, 'endpoints': args.endpoints, 'rps': args.rps,
+                    'error_rate': args.error_rate, 'api_latency_ms': args.api_latency_ms,
+                },
+                'results': results,
+            }, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Microbenchmarks of per event and per tick hot paths of the wrapper, on synthetic fixtures with different numbers
+of endpoints, widths of response time histograms and error rates. For every case time per op and memory
+(tracemalloc peak and retained bytes per op) are measured. Results are saved as JSON and compared with baseline,
+cases slower or allocating more than `--threshold` are reported as regressions (exit code 1). Run from `tests`
+directory:
+
+    python -m bolt_benchmarks.microbenchmarks --output baseline.json
+    python -m bolt_benchmarks.microbenchmarks --baseline baseline.json --threshold 0.1
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+# benchmarks call master code of the wrapper, results are not sent to API
+os.environ.setdefault('BOLT_WORKER_TYPE', 'master')
+os.environ.setdefault('BOLT_EXECUTION_ID', 'microbenchmarks')
+os.environ.setdefault('BOLT_LOCUSTFILE_NAME', 'bolt_benchmarks.noop_locustfile')
+
+from locust.env import Environment  # noqa: E402
+
+import bolt_locust_wrapper  # noqa: E402
+from bolt_api_client import BoltAPIClient  # noqa: E402
+from bolt_locust_wrapper_parser import get_response_times_median_for_every_endpoint  # noqa: E402
+from bolt_utils.bolt_chunking import ChunkSizer  # noqa: E402
+from bolt_utils.bolt_event_sampling import EventSample  # noqa: E402
+from bolt_utils.bolt_latency_sketch import LatencySketch, serialize_sketches  # noqa: E402
+from bolt_utils.bolt_payload_builder import identifier  # noqa: E402
+from bolt_utils.bolt_transport import WrappedTransport  # noqa: E402
+
+WORKERS = 4
+TIMESTAMP = 1700000000.0
+# cases of every benchmark: product of parameters
+ENDPOINTS = (10, 100, 1000)
+HISTOGRAM_WIDTHS = (10, 100)
+ERROR_RATES = (0.0, 0.05)
+EVENTS_PER_INTERVAL = 1000
+# ops measured with tracemalloc (tracing is slow)
+MEMORY_OPS = 5
+
+
+def endpoint_names(endpoints):
+    return [f'/api/v1/resource/{i}' for i in range(endpoints)]
+
+
+def response_times_histogram(rng, width):
+    # response times are rounded by locust, histogram has `width` distinct buckets
+    return {int(rng.lognormvariate(4, 0.6)) + i * 3: rng.randint(1, 50) for i in range(width)}
+
+
+def worker_report(rng, endpoints, width, error_rate):
+    """
+    Report of single worker as sent to master (locust stats with wrapper additions)
+    """
+    stats = []
+    errors = {}
+    sketches = {}
+    for name in endpoint_names(endpoints):
+        response_times = response_times_histogram(rng, width)
+        num_requests = sum(response_times.values())
+        num_failures = int(num_requests * error_rate)
+        stats.append({
+            'name': name, 'method': 'GET', 'last_request_timestamp': TIMESTAMP, 'start_time': TIMESTAMP - 3,
+            'num_requests': num_requests, 'num_none_requests': 0, 'num_failures': num_failures,
+            'total_response_time': sum(rt * count for rt, count in response_times.items()),
+            'max_response_time': max(response_times), 'min_response_time': min(response_times),
+            'total_content_length': num_requests * 2048, 'response_times': response_times,
+            'num_reqs_per_sec': {int(TIMESTAMP): num_requests}, 'num_fail_per_sec': {int(TIMESTAMP): num_failures},
+        })
+        if num_failures:
+            error = f'HTTPError(\'500 Server Error for url: {name}\')'
+            errors[f'GET.{name}.{error}'] = {'name': name, 'method': 'GET', 'error': error, 'occurrences': num_failures}
+        sketch = sketches[('GET', name)] = LatencySketch()
+        for response_time, count in response_times.items():
+            sketch.add(response_time, count)
+    total_requests = sum(entry['num_requests'] for entry in stats)
+    return {
+        'stats': stats,
+        'stats_total': {
+            'name': 'Aggregated', 'method': '', 'num_requests': total_requests,
+            'num_failures': sum(entry['num_failures'] for entry in stats),
+            'total_response_time': sum(entry['total_response_time'] for entry in stats),
+            'total_content_length': total_requests * 2048,
+        },
+        'errors': errors,
+        'user_count': 10,
+        'latency_sketches': serialize_sketches(sketches),
+    }
+
+
+def interval_events(rng, endpoints, error_rate):
+    """
+    Events of single interval counted on master (local requests)
+    """
+    events = EventSample()
+    names = endpoint_names(endpoints)
+    for _ in range(EVENTS_PER_INTERVAL):
+        name = rng.choice(names)
+        exception = 'HTTPError(500)' if rng.random() < error_rate else None
+        response_time = rng.lognormvariate(4, 0.6)
+        events.offer('GET', name, response_time, 2048, exception, int(TIMESTAMP))
+    return events
+
+
+def tick_stats(rng, endpoints, width, error_rate):
+    """
+    Stats of single tick prepared by master, as passed to `insert_requests_distribution_results`
+    """
+    names = endpoint_names(endpoints)
+    reports = [worker_report(rng, endpoints, width, error_rate) for _ in range(WORKERS)]
+    return {
+        'execution_id': 'microbenchmarks', 'tick': TIMESTAMP, 'requests': reports,
+        'median_response_time_per_endpoint': {name: 55 for name in names},
+        'avg_req_per_sec_per_endpoint': {name: 40 for name in names},
+        'average_response_size': 2048,
+        'error_details': [error for report in reports for error in report['errors'].values()],
+    }
+
+
+class Clock(object):
+    """
+    Clock of wrapper, time is moved only by benchmarks
+    """
+    def __init__(self):
+        self.now = TIMESTAMP
+
+    def __call__(self):
+        return self.now
+
+
+CLOCK = Clock()
+
+
+class CapturingTransport(WrappedTransport):
+    """
+    Transport which encodes payload as for API, but does not send it
+    """
+    def post(self, post_args):
+        return {'data': {}}
+
+
+def reset_wrapper():
+    wrapper = bolt_locust_wrapper.locust_wrapper
+    wrapper.dataset = []
+    wrapper.dataset_timestamps = []
+    wrapper.prepared_stats = 0
+    wrapper.stats_queue = []
+    wrapper.users = []
+    wrapper.errors.clear()
+    CLOCK.now = TIMESTAMP
+    return wrapper
+
+
+def setup_wrapper():
+    wrapper = bolt_locust_wrapper.locust_wrapper
+    wrapper.environment = Environment()
+    wrapper.environment.create_local_runner()
+    # wrapper waits for all workers of master runner before aggregating reports
+    wrapper.environment.parsed_options = argparse.Namespace(expect_workers=0)
+    wrapper.environment.runner.clients = {}
+    wrapper.is_started = True
+    # prepared stats are not scheduled for sending
+    wrapper.schedule_stats = lambda stats: None
+    wrapper.clock = CLOCK
+
+
+def bench_push_event(rng, endpoints, error_rate):
+    wrapper = reset_wrapper()
+    reports = itertools.cycle([worker_report(rng, endpoints, 10, error_rate) for _ in range(WORKERS)])
+
+    def push_event():
+        # every report comes in next interval (as from workers), so intervals roll over as in test
+        CLOCK.now += bolt_locust_wrapper.SENDING_INTERVAL_IN_SECONDS
+        wrapper.push_event(next(reports), 'master')
+    return push_event
+
+
+def bench_prepare_stats_by_interval_common(rng, endpoints, error_rate):
+    wrapper = reset_wrapper()
+    data = {TIMESTAMP: interval_events(rng, endpoints, error_rate)}
+    return lambda: wrapper.prepare_stats_by_interval_common(data)
+
+
+def bench_prepare_stats_by_interval_master(rng, endpoints, width, error_rate):
+    wrapper = reset_wrapper()
+    data = {TIMESTAMP: [worker_report(rng, endpoints, width, error_rate) for _ in range(WORKERS)]}
+    return lambda: wrapper.prepare_stats_by_interval_master(data)
+
+
+def bench_median_for_every_endpoint(rng, endpoints, width):
+    response_times = {name: response_times_histogram(rng, width) for name in endpoint_names(endpoints)}
+    # medians replace histograms in passed dict
+    return lambda: get_response_times_median_for_every_endpoint(dict(response_times))
+
+
+def bench_identifier(rng, endpoints):
+    parts = itertools.cycle([['GET', name] for name in endpoint_names(endpoints)])
+    return lambda: identifier(next(parts))
+
+
+def bench_insert_requests_distribution_results(rng, endpoints, error_rate):
+    api_client = bolt_locust_wrapper.locust_wrapper.bolt_api_client
+    api_client.gql_client.transport = CapturingTransport(
+        url='http://127.0.0.1/v1/graphql', use_json=True, headers={}
+    )
+    # chunk size adapts to upload latency, every case starts with the same one
+    api_client.chunk_sizer = ChunkSizer()
+    stats = tick_stats(rng, endpoints, 10, error_rate)
+    # without logging of execution time
+    insert = BoltAPIClient.insert_requests_distribution_results.__wrapped__
+    return lambda: insert(api_client, stats)
+
+
+BENCHMARKS = {
+    'push_event': (bench_push_event, {'endpoints': ENDPOINTS, 'error_rate': ERROR_RATES}),
+    'prepare_stats_by_interval_common': (
+        bench_prepare_stats_by_interval_common, {'endpoints': ENDPOINTS, 'error_rate': ERROR_RATES}
+    ),
+    'prepare_stats_by_interval_master': (
+        bench_prepare_stats_by_interval_master,
+        {'endpoints': ENDPOINTS, 'width': HISTOGRAM_WIDTHS, 'error_rate': ERROR_RATES}
+    ),
+    'median_for_every_endpoint': (
+        bench_median_for_every_endpoint, {'endpoints': ENDPOINTS, 'width': HISTOGRAM_WIDTHS}
+    ),
+    'identifier': (bench_identifier, {'endpoints': (1000,)}),
+    'insert_requests_distribution_results': (
+        bench_insert_requests_distribution_results, {'endpoints': ENDPOINTS, 'error_rate': ERROR_RATES}
+    ),
+}
+
+
+def cases(selected):
+    for name, (setup, parameters) in BENCHMARKS.items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        for values in itertools.product(*parameters.values()):
+            kwargs = dict(zip(parameters, values))
+            case = name + ''.join(f'[{key}={value}]' for key, value in kwargs.items())
+            yield case, setup, kwargs
+
+
+def measure(op, min_time, repeat):
+    """
+    Return per op times (seconds) of `repeat` runs, every run lasts at least `min_time`
+    """
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            op()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / elapsed))
+    times = []
+    gc.collect()
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                op()
+            times.append((time.perf_counter() - started) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return times
+
+
+def measure_memory(op):
+    """
+    Return highest peak of memory during op and bytes retained by op (average of `MEMORY_OPS` ops)
+    """
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    try:
+        started, _ = tracemalloc.get_traced_memory()
+        for _ in range(MEMORY_OPS):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            op()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        retained = tracemalloc.get_traced_memory()[0] - started
+    finally:
+        tracemalloc.stop()
+    return peak, retained // MEMORY_OPS
+
+
+def run(selected, min_time, repeat):
+    setup_wrapper()
+    results = {}
+    for case, setup, kwargs in cases(selected):
+        op = setup(random.Random(case), **kwargs)
+        # warm up caches (identifiers, prepared queries)
+        op()
+        times = measure(op, min_time, repeat)
+        op = setup(random.Random(case), **kwargs)
+        op()
+        peak, retained = measure_memory(op)
+        results[case] = {
+            'time_us': round(statistics.median(times) * 1e6, 3),
+            'time_us_min': round(min(times) * 1e6, 3),
+            'peak_bytes': peak,
+            'retained_bytes': retained,
+        }
+        print(f'{case:<90} {results[case]["time_us"]:>12.3f}us {peak / 1024:>10.1f}KiB', file=sys.stderr)
+    reset_wrapper()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return list of regressions: (case, metric, baseline value, current value)
+    """
+    regressions = []
+    for case, result in results.items():
+        previous = baseline.get(case)
+        if previous is None:
+            continue
+        # the fastest run is the least disturbed by other processes
+        for metric in ('time_us_min', 'peak_bytes'):
+            if previous[metric] and result[metric] > previous[metric] * (1 + threshold):
+                regressions.append((case, metric, previous[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', action='append', help='run only benchmarks with name containing this text')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimal time of single run (seconds)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs of every case')
+    parser.add_argument('--output', help='file for results (JSON)')
+    parser.add_argument('--baseline', help='results (JSON) to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative increase (0.1 - 10%%)')
+    args = parser.parse_args()
+
+    results = run(args.filter, args.min_time, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': sys.version.split()[0],
+                'results': results,
+            }, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for case, metric, previous, current in regressions:
+            print(f'REGRESSION {case} {metric}: {previous} -> {current} ({(current / previous - 1) * 100:+.1f}%)')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions above {args.threshold * 100:.0f}% in {len(results)} cases')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Replay events recorded with BOLT_RECORD_DIR into wrapper listeners and write stats produced for every interval
+as JSON lines, so aggregation changes can be timed and diffed on the same input. Worker reports are also applied
+to `environment.stats` by locust listeners of master runner, so requests and failures per second are reproduced.
+Number of users comes from reports (replay runner has no users). Run from `tests` directory (BOLT_LOCUSTFILE_NAME
+is needed, because wrapper imports locustfile):
+
+    python -m bolt_benchmarks.replay_events bolt_events_master_1.msgpack --speed 0 --output stats.jsonl
+"""
+
+import argparse
+import json
+import os
+import time
+
+# replayed stats are not sent to API
+os.environ.setdefault('BOLT_WORKER_TYPE', 'master')
+os.environ.setdefault('BOLT_OFFLINE', 'true')
+os.environ.setdefault('BOLT_EXECUTION_ID', 'replay')
+
+from locust.env import Environment  # noqa: E402
+from locust.stats import setup_distributed_stats_event_listeners  # noqa: E402
+
+import bolt_locust_wrapper  # noqa: E402
+from bolt_utils import bolt_instrumentation  # noqa: E402
+from bolt_utils.bolt_logger import setup_custom_logger  # noqa: E402
+from bolt_utils.bolt_recorder import EventReplayer, REQUEST, TEST_INIT, TEST_START, WORKER_REPORT  # noqa: E402
+
+# keys of stats which depend on process state, not on replayed events
+VOLATILE_KEYS = (
+    'worker_resources', 'instrumentation', 'write_queues', 'circuit_breaker', 'transport_traffic',
+    'coalesced_writes', 'timestamp',
+)
+
+logger = setup_custom_logger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='msgpack log of recorded events')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed (1 - original, 0 - no delays)')
+    parser.add_argument('--output', help='file for stats of every interval (JSON lines)')
+    args = parser.parse_args()
+
+    wrapper = bolt_locust_wrapper.locust_wrapper
+    wrapper.environment = environment = Environment()
+    # the same listeners as master runner registers, they merge worker reports into environment.stats
+    setup_distributed_stats_event_listeners(environment.events, environment.stats)
+    runner = wrapper.environment.create_local_runner()
+    # wrapper waits for all workers of master runner before aggregating reports
+    wrapper.environment.parsed_options = argparse.Namespace(expect_workers=0)
+    runner.clients = {}
+    wrapper.is_started = True
+    produced = []
+    wrapper.schedule_stats = produced.append
+
+    def test_start(timestamp):
+        # master runner clears stats before test start event
+        environment.stats.clear_all()
+        environment.stats.total.start_time = timestamp
+
+    def worker_report(client_id, data):
+        # on master wrapper listener is registered first (on import), so it gets report before stats are merged
+        bolt_locust_wrapper.report_from_slave_handler(client_id=client_id, data=data)
+        environment.events.worker_report.fire(client_id=client_id, data=data)
+
+    replayer = EventReplayer(args.path, {
+        TEST_INIT: wrapper.start_dataset,
+        TEST_START: test_start,
+        WORKER_REPORT: worker_report,
+        REQUEST: bolt_locust_wrapper.request_handler,
+    }, speed=args.speed)
+    wrapper.clock = replayer.clock
+
+    started = time.process_time()
+    events = replayer.replay()
+    wrapper.save_stats(send_all=True)
+    cpu_time = time.process_time() - started
+    logger.info(f'Replayed {events} events into {len(produced)} intervals, CPU time {cpu_time:.3f}s')
+    bolt_instrumentation.report(logger)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            for stats in produced:
+                stats = {key: value for key, value in stats.items() if key not in VOLATILE_KEYS}
+                file.write(json.dumps(stats, sort_keys=True, default=str) + '\n')
+
+
+if __name__ == '__main__':
+    main()
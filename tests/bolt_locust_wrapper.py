@@ -23,19 +23,45 @@ during test execution. For all imports we add `wrap_` prefix.
 """
 import math
 import os as wrap_os
-import re as wrap_re
 import time as wrap_time
 import datetime as wrap_datetime
 
 import locust.stats as wrap_locust_stats
 
 from locust import events as wrap_events
-from locust.runners import MasterRunner
+from locust.runners import MasterRunner, WorkerRunner
 
 from bolt_utils.bolt_logger import setup_custom_logger as wrap_setup_custom_logger
 from bolt_api_client import BoltAPIClient as WrapBoltAPIClient
+from bolt_api_client import FINAL_WRITES_TIMEOUT as WRAP_FINAL_WRITES_TIMEOUT
 import bolt_locust_wrapper_parser as parser
 from bolt_utils.bolt_stat_watcher import StatWatcher
+from bolt_utils.bolt_enums import WriteLane as WrapWriteLane
+from bolt_utils.bolt_exceptions import CircuitOpenError as WrapCircuitOpenError
+from bolt_utils.bolt_error_aggregator import ErrorAggregator as WrapErrorAggregator
+from bolt_utils.bolt_error_aggregator import ErrorRecord as WrapErrorRecord
+from bolt_utils.bolt_error_aggregator import error_key as wrap_error_key
+from bolt_utils.bolt_error_aggregator import OTHER_ERRORS as WRAP_OTHER_ERRORS
+from bolt_utils.bolt_error_aggregator import MAX_ERROR_KEYS as WRAP_MAX_ERROR_KEYS
+from bolt_utils.bolt_resource_telemetry import ResourceSampler as WrapResourceSampler
+from bolt_utils.bolt_resource_telemetry import ResourceAggregator as WrapResourceAggregator
+from bolt_utils.bolt_loop_lag import LoopLagMonitor as WrapLoopLagMonitor
+from bolt_utils.bolt_loop_lag import LOOP_LAG_MONITOR as WRAP_LOOP_LAG_MONITOR
+import bolt_utils.bolt_instrumentation as wrap_instrumentation
+from bolt_utils.bolt_quantiles import DISTRIBUTION_SNAPSHOT_INTERVAL as WRAP_DISTRIBUTION_SNAPSHOT_INTERVAL
+from bolt_utils.bolt_latency_sketch import LatencySketch as WrapLatencySketch
+from bolt_utils.bolt_latency_sketch import LATENCY_SKETCH as WRAP_LATENCY_SKETCH
+from bolt_utils.bolt_latency_sketch import serialize_sketches as wrap_serialize_sketches
+from bolt_utils.bolt_latency_sketch import merge_serialized_sketches as wrap_merge_serialized_sketches
+from bolt_utils.bolt_slowest_requests import SlowestRequests as WrapSlowestRequests
+from bolt_utils.bolt_slowest_requests import request_exemplar as wrap_request_exemplar
+from bolt_utils.bolt_slowest_requests import SLOWEST_REQUESTS as WRAP_SLOWEST_REQUESTS
+from bolt_utils.bolt_event_sampling import EventSample as WrapEventSample
+from bolt_utils.bolt_recorder import recorder_for as wrap_recorder_for
+from bolt_utils.bolt_recorder import WORKER_REPORT as WRAP_WORKER_REPORT
+from bolt_utils.bolt_recorder import REQUEST as WRAP_REQUEST
+from bolt_utils.bolt_recorder import TEST_INIT as WRAP_TEST_INIT
+from bolt_utils.bolt_recorder import TEST_START as WRAP_TEST_START
 
 # TODO: temporary solution for disabling warnings
 import urllib3
@@ -50,6 +76,8 @@ EXECUTION_ID = wrap_os.getenv('BOLT_EXECUTION_ID')
 WORKER_TYPE = wrap_os.getenv('BOLT_WORKER_TYPE')
 LOCUSTFILE_NAME = wrap_os.getenv('BOLT_LOCUSTFILE_NAME')
 TEST_DURATION = int(wrap_os.getenv('BOLT_TEST_DURATION', 1))
+# maximal number of ticks kept for retry (shed from write queue or failed), the oldest ones are dropped
+STATS_QUEUE_LIMIT = int(wrap_os.getenv('BOLT_STATS_QUEUE_LIMIT', '300'))
 
 wrap_locust_stats.CSV_STATS_INTERVAL_SEC = SENDING_INTERVAL_IN_SECONDS
 wrap_logger = wrap_setup_custom_logger(__name__)
@@ -60,6 +88,11 @@ STAT_WATCHER_INSTANCE = None
 # dynamically import source code from locustfile with tests
 exec(f'from {LOCUSTFILE_NAME} import *')
 
+# interval between requests expected by locustfile (`BOLT_EXPECTED_INTERVAL_MS` in locustfile or env) enables
+# correction of coordinated omission in latency sketches
+EXPECTED_INTERVAL_MS = float(globals().get('BOLT_EXPECTED_INTERVAL_MS') or
+                             wrap_os.getenv('BOLT_EXPECTED_INTERVAL_MS', '0'))
+
 
 class LocustWrapper(object):
     """
@@ -67,10 +100,12 @@ class LocustWrapper(object):
     """
     dataset = []
     dataset_timestamps = []
-    errors = {}
-    stats = []
+    # number of prepared ticks (prepared stats are not kept, they are only sent)
+    prepared_stats = 0
     stats_queue = []
+    dropped_stats = 0
     users = []
+    last_distribution_snapshot = 0
     start_execution: wrap_datetime.datetime = None
     end_execution: wrap_datetime.datetime = None
     is_started = False
@@ -82,7 +117,43 @@ class LocustWrapper(object):
             self.bolt_api_client = WrapBoltAPIClient()
         self.execution = EXECUTION_ID
         self.cpu_warned = False
+        self.errors = WrapErrorAggregator(other_entry={
+            'execution_id': self.execution, 'name': WRAP_OTHER_ERRORS, 'error_type': WRAP_OTHER_ERRORS,
+            'exception_data': f'Errors outside of top {WRAP_MAX_ERROR_KEYS}'
+        }, formatter=lambda record: {
+            'execution_id': self.execution, 'name': record.name, 'error_type': record.method,
+            'exception_data': record.error
+        })
+        self.resources = WrapResourceAggregator()
+        self.resource_sampler = None
+        self.loop_lag = {}
+        # summaries of instrumented calls on workers (request handlers) since previous tick
+        self.worker_instrumentation = {}
+        self.loop_lag_monitor = None
+        self.loop_lag_warned = set()
+        self.latency_sketches = None
+        self.corrected_latency_sketches = None
+        self.slowest_requests = None
+        # recorder of worker reports and requests (BOLT_RECORD_DIR)
+        self.recorder = wrap_recorder_for(WORKER_TYPE or 'local')
+        # source of time for intervals, replaced by replayer of recorded events
+        self.clock = wrap_time.time
+
+    @staticmethod
+    def latency_percentiles(latency_sketches, corrected_latency_sketches):
+        percentiles = {
+            f'{method} {name}': {
+                **{f'p{percent}': value for percent, value in sketch.quantiles().items()}, 'count': sketch.count
+            } for (method, name), sketch in latency_sketches.items()
+        }
+        # percentiles corrected for coordinated omission are reported next to raw ones
+        for (method, name), sketch in corrected_latency_sketches.items():
+            percentiles[f'{method} {name}']['corrected'] = {
+                **{f'p{percent}': value for percent, value in sketch.quantiles().items()}, 'count': sketch.count
+            }
+        return percentiles
 
+    @wrap_instrumentation.instrumented('prepare_stats_by_interval_common')
     def prepare_stats_by_interval_common(self, data):
         """
         Preparing stats data by interval for sending to database for common cases
@@ -98,7 +169,7 @@ class LocustWrapper(object):
         stats = {}
         timestamp = list(data.keys())[0]
         elements = data[timestamp]
-        if not elements:
+        if not getattr(elements, 'seen', 0):
             empty_stats = {
                 'execution_id': locust_wrapper.execution,
                 'timestamp': wrap_datetime.datetime.utcfromtimestamp(timestamp).isoformat(),
@@ -113,22 +184,32 @@ class LocustWrapper(object):
         # prepare dict for stats
         stats['execution_id'] = self.execution
         stats['timestamp'] = wrap_datetime.datetime.utcfromtimestamp(timestamp).isoformat()
-        stats['number_of_successes'] = len([el for el in elements if el['event_type'] == 'success'])
-        stats['number_of_fails'] = len([el for el in elements if el['event_type'] == 'failure'])
-        stats['number_of_errors'] = len(set([el['exception'] for el in elements if bool(el['exception'])]))
+        # counters are exact even if only part of request records was kept
+        stats['number_of_successes'] = elements.successes
+        stats['number_of_fails'] = elements.failures
+        stats['number_of_errors'] = len(elements.exceptions)
         number_of_users = self.environment.runner.user_count
         if number_of_users == 0 and len(self.users):
             number_of_users = int(sum(self.users) / len(self.users) * 0.60)
         stats['number_of_users'] = number_of_users
-        average_response_time = sum([el['response_time'] for el in elements]) / float(len(elements))
-        stats['average_response_time'] = round(average_response_time, 2)
-        average_response_size = sum([el['response_length'] for el in elements]) / float(len(elements))
-        stats['average_response_size'] = round(average_response_size, 2)
-        self.stats.append(stats)
+        stats['average_response_time'] = round(elements.total_response_time / float(elements.seen), 2)
+        stats['average_response_size'] = round(elements.total_response_length / float(elements.seen), 2)
+        if elements.is_sampled:
+            stats['event_sampling'] = elements.summary()
+        if self.latency_sketches:
+            # sketches of local runner contain requests since previous interval
+            stats['latency_percentiles'] = self.latency_percentiles(
+                self.latency_sketches, self.corrected_latency_sketches or {}
+            )
+            self.latency_sketches = {}
+            if self.corrected_latency_sketches is not None:
+                self.corrected_latency_sketches = {}
+        self.prepared_stats += 1
         self.users.append(self.environment.runner.user_count)
-        stats['error_details'] = self.errors
+        stats['error_details'] = self.errors.values()
         return stats
 
+    @wrap_instrumentation.instrumented('prepare_stats_by_interval_master')
     def prepare_stats_by_interval_master(self, data):
         """
         Preparing stats data by interval for sending to database when WORKER_TYPE is 'master'
@@ -151,7 +232,10 @@ class LocustWrapper(object):
         timestamp = list(data.keys())[0]
         elements = data[timestamp]
         # prepare dict for stats
-        errors = []
+        errors = WrapErrorAggregator(count_field='occurrences', other_entry={
+            'method': WRAP_OTHER_ERRORS, 'name': WRAP_OTHER_ERRORS, 'error': WRAP_OTHER_ERRORS
+        })
+        error_keys = set()
         requests_per_second = int(round(locust_wrapper.environment.stats.total.current_rps, 0))
         failures_per_second = int(round(locust_wrapper.environment.stats.total.current_fail_per_sec, 0))
         if requests_per_second == 0:
@@ -163,6 +247,9 @@ class LocustWrapper(object):
         user_count = 0
         number_of_request_per_second = {}
         response_times_per_endpoint = {}
+        latency_sketches = {}
+        corrected_latency_sketches = {}
+        slowest_requests = WrapSlowestRequests()
         response_times = []
         content_lengths = []
         for el in elements:
@@ -181,50 +268,96 @@ class LocustWrapper(object):
                     current_ep_times = 0
                 number_of_request_per_second[endpoint["name"]] = current_ep_rps
                 response_times_per_endpoint[endpoint["name"]] = current_ep_times
+            # latency sketches from workers contain only requests since previous report
+            wrap_merge_serialized_sketches(latency_sketches, el.get('latency_sketches', ()))
+            wrap_merge_serialized_sketches(corrected_latency_sketches, el.get('corrected_latency_sketches', ()))
+            slowest_requests.merge(el.get('slowest_requests', ()))
             if el['errors']:
-                errors.extend(list(el['errors'].values()))
+                for error in el['errors'].values():
+                    key = wrap_error_key(error['method'], error['name'], error['error'])
+                    error_keys.add(key)
+                    errors.add(key, error['occurrences'], lambda: WrapErrorRecord(
+                        error['method'], error['name'], error['error']
+                    ))
 
         stats["requests"] = elements
         stats['execution_id'] = self.execution
+        # index of interval, intervals start at least SENDING_INTERVAL_IN_SECONDS apart (see `current_events`)
+        stats['tick'] = int(timestamp) // SENDING_INTERVAL_IN_SECONDS
         stats['timestamp'] = wrap_datetime.datetime.utcfromtimestamp(timestamp).isoformat()
         stats['number_of_successes'] = requests_per_second - failures_per_second
         stats['number_of_fails'] = failures_per_second
-        stats['median_response_time_per_endpoint'] = parser.get_response_times_median_for_every_endpoint(
-            response_times_per_endpoint
-        )
+        if latency_sketches:
+            stats['median_response_time_per_endpoint'] = {
+                name: sketch.quantiles((50,))[50] for (method, name), sketch in latency_sketches.items()
+            }
+            stats['latency_percentiles'] = self.latency_percentiles(latency_sketches, corrected_latency_sketches)
+        else:
+            stats['median_response_time_per_endpoint'] = parser.get_response_times_median_for_every_endpoint(
+                response_times_per_endpoint
+            )
         stats['avg_req_per_sec_per_endpoint'] = number_of_request_per_second
+        if slowest_requests:
+            stats['slowest_requests'] = {
+                f'{method} {name}': exemplars for method, name, exemplars in slowest_requests.serialize()
+            }
 
         number_of_users = self.environment.runner.user_count
         if number_of_users == 0 and user_count > 0:
             number_of_users = user_count
         stats['number_of_users'] = number_of_users
 
-        number_of_errors = len(set(
-            ['{0}/{1}/{2}'.format(error['method'], error['name'], error['error']) for error in errors]))
-        stats['number_of_errors'] = number_of_errors
+        stats['number_of_errors'] = len(error_keys)
 
         stats['average_response_time'] = round(locust_wrapper.environment.stats.total.avg_response_time)
         stats['average_response_size'] = round(locust_wrapper.environment.stats.total.avg_content_length)
 
-        self.stats.append(stats)
+        self.prepared_stats += 1
         self.users.append(self.environment.runner.user_count)
-        stats['error_details'] = errors
+        stats['error_details'] = errors.values()
+        stats['worker_resources'] = self.resources.flush()
+        if self.loop_lag_monitor is not None:
+            self.loop_lag['master'] = self.loop_lag_monitor.snapshot()
+        stats['loop_lag'], self.loop_lag = self.loop_lag, {}
+        stats['instrumentation'] = wrap_instrumentation.sample()
+        stats['worker_instrumentation'], self.worker_instrumentation = self.worker_instrumentation, {}
+        stats['write_queues'] = self.bolt_api_client.write_scheduler.depths()
+        stats['circuit_breaker'] = self.bolt_api_client.gql_client.transport.circuit_breaker.stats()
+        stats['transport_traffic'] = self.bolt_api_client.gql_client.transport.traffic_stats()
+        stats['coalesced_writes'] = self.bolt_api_client.coalescer.stats()
         return stats
 
+    def schedule_stats(self, stats):
+        # stats shed from full write queue are kept in 'stats_queue' and sent at the end of test
+        self.bolt_api_client.schedule_write(
+            WrapWriteLane.DETAILS, save_to_database, stats, on_shed=self.queue_stats
+        )
+
+    def queue_stats(self, stats):
+        # queue is limited, so long API outage does not keep all ticks of test in memory
+        if len(self.stats_queue) >= STATS_QUEUE_LIMIT:
+            self.stats_queue.pop(0)
+            self.dropped_stats += 1
+            wrap_logger.warning(f'Queue of failed stats is full. Dropped the oldest tick ({self.dropped_stats} so far)')
+        self.stats_queue.append(stats)
+
+    def resend_failed_stats(self):
+        failed_stats, self.stats_queue = self.stats_queue, []
+        for stats in failed_stats:
+            self.schedule_stats(stats)
+
     def save_stats(self, send_all=False):
         # will be executed on the end test runner for sending all available data to database
         if send_all:
+            # send stats from queue if we lost connection during sending stats to database
+            self.resend_failed_stats()
             for element in self.dataset:
                 if WORKER_TYPE == 'master':
                     stats = self.prepare_stats_by_interval_master(element)
                 else:
                     stats = self.prepare_stats_by_interval_common(element)
                 if stats is not None:
-                    self.stats_queue.append(stats)
-                    save_to_database(stats)
-            # send stats from queue if we lost connection during sending stats to database
-            for stats in self.stats_queue:
-                save_to_database(stats)
+                    self.schedule_stats(stats)
         # send first element from list to database if length of list more than 2
         elif len(self.dataset) > 0:
             first_element = self.dataset.pop(0)
@@ -233,62 +366,83 @@ class LocustWrapper(object):
             else:
                 stats = self.prepare_stats_by_interval_common(first_element)
             if stats is not None:
-                # add stats to queue for sending
-                self.stats_queue.append(stats)
-                # send as locust event
-                save_to_database(stats)
+                self.schedule_stats(stats)
+
+    @staticmethod
+    def interval_events():
+        # master keeps reports of workers, other runners count their requests
+        return [] if WORKER_TYPE == 'master' else WrapEventSample()
 
+    def start_dataset(self, timestamp):
+        # the first interval starts with test, before any event
+        if not self.dataset:
+            self.dataset.append({timestamp: self.interval_events()})
+            self.dataset_timestamps.append(int(timestamp))
+
+    @wrap_instrumentation.instrumented('push_event')
     def push_event(self, data, event_type):
-        # extracting errors for common cases (when WORKER_TYPE is not 'master' or 'slave')
-        if event_type == 'failure':
-            combined_key = '{0}/{1}/{2}'.format(data['request_type'], data['endpoint'], data['exception'])
-            combined_key = wrap_re.sub(r' object at 0x\S*', '', combined_key)  # delete trash (obj address) from key
-            try:
-                error = self.errors[combined_key]
-                error['number_of_occurrences'] = error['number_of_occurrences'] + 1
-            except KeyError:
-                new_error = {combined_key: {
-                    'execution_id': self.execution, 'number_of_occurrences': 1, 'name': data['endpoint'],
-                    'error_type': data['request_type'], 'exception_data': data['exception']
-                }}
-                self.errors.update(new_error)
-        # extracting errors when WORKER_TYPE is 'master'
-        elif event_type == 'master' and 'errors' in data.keys() and data['errors']:
+        # extracting errors when WORKER_TYPE is 'master' (errors of single requests are extracted in `push_request`)
+        if event_type == 'master' and 'errors' in data.keys() and data['errors']:
+            # errors from worker report contain only occurrences since previous report
             for error in data['errors'].values():
-                combined_key = '{0}/{1}/{2}'.format(error['method'], error['name'], error['error'])
-                combined_key = wrap_re.sub(r' object at 0x\S*', '', combined_key)  # delete trash (obj address) from key
-                try:
-                    _error = self.errors[combined_key]
-                    _error['number_of_occurrences'] = error['occurences']
-                except KeyError:
-                    new_error = {combined_key: {
-                        'execution_id': self.execution, 'number_of_occurrences': error['occurrences'],
-                        'name': error['name'], 'error_type': error['method'], 'exception_data': error['error']
-                    }}
-                    self.errors.update(new_error)
+                combined_key = wrap_error_key(error['method'], error['name'], error['error'])
+                self.errors.add(combined_key, error['occurrences'], lambda: WrapErrorRecord(
+                    error['method'], error['name'], error['error']
+                ))
         # push event to dataset for common cases
-        now_timestamp = wrap_time.time()
+        self.current_events().append(data)
+        # try to save/send stats for interval
+        self.save_stats()
+
+    def current_events(self):
+        """
+        Return events of current interval from dataset, new interval is started after `SENDING_INTERVAL_IN_SECONDS`
+        """
+        now_timestamp = self.clock()
         try:
             last_timestamp = list(self.dataset[-1].keys())[0]
         except IndexError:
             last_timestamp = now_timestamp
 
         if len(self.dataset) == 0:
-            self.dataset.append({last_timestamp: []})
+            self.dataset.append({last_timestamp: self.interval_events()})
 
         if int(now_timestamp) - int(last_timestamp) < SENDING_INTERVAL_IN_SECONDS:
-            self.dataset[-1][last_timestamp].append(data)
-        else:
-            self.dataset.append({now_timestamp: [data]})
-            self.dataset_timestamps.append(int(now_timestamp))
+            return self.dataset[-1][last_timestamp]
+        events = self.interval_events()
+        self.dataset.append({now_timestamp: events})
+        self.dataset_timestamps.append(int(now_timestamp))
+        return events
+
+    @wrap_instrumentation.instrumented('push_request')
+    def push_request(self, request_type, name, response_time, response_length, exception):
+        """
+        Count single request in current interval, request is kept in columns of interval only when it is sampled
+        """
+        if exception is not None:
+            exception = str(exception)
+            combined_key = wrap_error_key(request_type, name, exception)
+            self.errors.add(combined_key, 1, lambda: WrapErrorRecord(request_type, name, exception))
+        events = self.current_events()
+        # ticks of master are built from locust stats and reports of workers, its requests are only counted in errors
+        if WORKER_TYPE != 'master':
+            events.offer(request_type, name, float(response_time), response_length, exception, int(self.clock()))
         # try to save/send stats for interval
         self.save_stats()
 
     def cpu_warning(self, *args, **kwargs):
         if not self.cpu_warned:
-            self.bolt_api_client.warn_about_high_cpu_usage(EXECUTION_ID)
+            self.bolt_api_client.schedule_write(
+                WrapWriteLane.STATUS, self.bolt_api_client.warn_about_high_cpu_usage, EXECUTION_ID
+            )
             self.cpu_warned = True
 
+    def loop_lag_warning(self, node_id, lag_ms):
+        if node_id not in self.loop_lag_warned:
+            wrap_logger.warning(f'Event loop of {node_id} was blocked for {lag_ms}ms. '
+                                f'Response times reported by this node may be inflated.')
+            self.loop_lag_warned.add(node_id)
+
 
 locust_wrapper = LocustWrapper()
 
@@ -308,28 +462,61 @@ def stat_worker_job():
             'average_response_size': 0, # TODO count correct size
             'execution_id': EXECUTION_ID,
         }
-        locust_wrapper.bolt_api_client.insert_aggregated_results(data)
+        locust_wrapper.bolt_api_client.schedule_write(
+            WrapWriteLane.AGGREGATES, locust_wrapper.bolt_api_client.insert_aggregated_results, data
+        )
     if locust_errors := locust_wrapper.errors:
-        errors = list(locust_errors.values())
+        errors = locust_errors.values()
         for error in errors:
             error.pop('execution_id', None)
-        locust_wrapper.bolt_api_client.insert_error_results(errors)
-        locust_wrapper.errors = {}
+        locust_wrapper.bolt_api_client.schedule_write(
+            WrapWriteLane.AGGREGATES, locust_wrapper.bolt_api_client.insert_error_results, errors
+        )
+        locust_errors.clear()
+    now = wrap_time.time()
+    if WRAP_DISTRIBUTION_SNAPSHOT_INTERVAL and \
+            now - locust_wrapper.last_distribution_snapshot >= WRAP_DISTRIBUTION_SNAPSHOT_INTERVAL:
+        # pending snapshot is replaced by newer one
+        locust_wrapper.bolt_api_client.schedule_write(
+            WrapWriteLane.DETAILS, locust_wrapper.bolt_api_client.insert_distribution_snapshot,
+            EXECUTION_ID, env.stats, coalesce_key='distribution_snapshot'
+        )
+        locust_wrapper.last_distribution_snapshot = now
 
 
 @wrap_events.request.add_listener
+@wrap_instrumentation.instrumented('request_handler')
 def request_handler(request_type, name, response_time, response_length, response, context, exception, start_time, url):
     """
     Handler for catching unsuccessful requests
     """
+    if locust_wrapper.recorder is not None:
+        locust_wrapper.recorder.record(
+            WRAP_REQUEST, request_type=request_type, name=name, response_time=response_time,
+            response_length=response_length, response=None, context=context, exception=exception,
+            start_time=start_time, url=url
+        )
     if WORKER_TYPE == 'master':
-        event_type = 'failure' if exception is not None else 'success'
-        received_data = {
-            'execution_id': locust_wrapper.execution, 'endpoint': name, 'exception': str(exception),
-            'request_type': request_type, 'response_length': response_length, 'response_time': float(response_time),
-            'event_type': event_type, 'timestamp': int(wrap_time.time()),
-        }
-        locust_wrapper.push_event(received_data, event_type=event_type)
+        locust_wrapper.push_request(request_type, name, response_time, response_length, exception)
+        return
+    if locust_wrapper.slowest_requests is not None and response_time is not None:
+        locust_wrapper.slowest_requests.add(
+            (request_type, name), response_time, lambda: wrap_request_exemplar(
+                start_time, response_time, response_length, response, context, exception, url
+            )
+        )
+    if locust_wrapper.latency_sketches is not None and response_time is not None:
+        try:
+            sketch = locust_wrapper.latency_sketches[(request_type, name)]
+        except KeyError:
+            sketch = locust_wrapper.latency_sketches[(request_type, name)] = WrapLatencySketch()
+        sketch.add(response_time)
+        if locust_wrapper.corrected_latency_sketches is not None:
+            try:
+                sketch = locust_wrapper.corrected_latency_sketches[(request_type, name)]
+            except KeyError:
+                sketch = locust_wrapper.corrected_latency_sketches[(request_type, name)] = WrapLatencySketch()
+            sketch.add_with_expected_interval(response_time, EXPECTED_INTERVAL_MS)
 
 #is used
 
@@ -338,31 +525,65 @@ def quitting_handler(exit_code):
     """
     Will be called before exiting test runner
     """
+    if locust_wrapper.resource_sampler is not None:
+        locust_wrapper.resource_sampler.stop()
+    if locust_wrapper.loop_lag_monitor is not None:
+        locust_wrapper.loop_lag_monitor.stop()
+    if locust_wrapper.recorder is not None:
+        locust_wrapper.recorder.close()
+    if WORKER_TYPE != 'master':
+        # per request hot paths run on workers (and local runner), master reports its calls after final writes
+        wrap_instrumentation.report(wrap_logger)
     if not locust_wrapper.is_finished and WORKER_TYPE == 'master':
         locust_wrapper.is_finished = True
         wrap_logger.info('Begin quit handler')
         if locust_wrapper.environment.runner.cpu_warning_emitted:
             locust_wrapper.cpu_warning()
         locust_wrapper.end_execution = wrap_datetime.datetime.now()
-        execution_update_data = {'end_locust': locust_wrapper.end_execution.isoformat()}
-        locust_wrapper.bolt_api_client.update_execution(execution_id=EXECUTION_ID, data=execution_update_data)
-        # save remaining data from 'dataset' list
+        global STAT_WATCHER_INSTANCE
+        if isinstance(STAT_WATCHER_INSTANCE, StatWatcher):
+            STAT_WATCHER_INSTANCE.stop()
+        bolt_api_client = locust_wrapper.bolt_api_client
+        # final writes wait for API which is not available (circuit breaker is open) until deadline
+        deadline = wrap_time.monotonic() + WRAP_FINAL_WRITES_TIMEOUT
+        # save remaining data from 'dataset' list, ticks are flushed before totals and distributions are sent
         locust_wrapper.save_stats(send_all=True)
+        bolt_api_client.flush_writes()
+        attempt = 0
+        # ticks which failed during flush are back in 'stats_queue'
+        while locust_wrapper.stats_queue and bolt_api_client.wait_for_api(attempt, deadline):
+            locust_wrapper.resend_failed_stats()
+            bolt_api_client.flush_writes()
+            attempt += 1
+        if locust_wrapper.stats_queue and bolt_api_client.archive.start_outage_archiving():
+            # API was not available until deadline, remaining ticks are archived
+            locust_wrapper.resend_failed_stats()
+            bolt_api_client.flush_writes()
+        if locust_wrapper.stats_queue:
+            wrap_logger.error(f'{len(locust_wrapper.stats_queue)} ticks of results were not saved')
         # TODO find proper way to present this stats
-        # sum_success = sum([s['number_of_successes'] for s in locust_wrapper.stats])
-        wrap_logger.info(f'Count stats {len(locust_wrapper.stats)}')
+        wrap_logger.info(f'Count stats {locust_wrapper.prepared_stats}')
         wrap_logger.info(f'Locust start: {locust_wrapper.start_execution}. '
                          f'Locust end: {locust_wrapper.end_execution}')
         wrap_logger.info(f'Dataset timestamps {locust_wrapper.dataset_timestamps}')
+        execution_update_data = {'end_locust': locust_wrapper.end_execution.isoformat()}
+        bolt_api_client.write_until_available(
+            deadline, bolt_api_client.update_execution, execution_id=EXECUTION_ID, data=execution_update_data
+        )
         # prepare and send error results to database
         # locust_wrapper.bolt_api_client.insert_error_results(list(locust_wrapper.errors.values()))
-        locust_wrapper.bolt_api_client.insert_endpoint_totals(EXECUTION_ID, locust_wrapper.environment.stats)
-        locust_wrapper.bolt_api_client.insert_time_distribution_results(EXECUTION_ID, locust_wrapper.environment.stats)
-        locust_wrapper.bolt_api_client.update_execution(execution_id=EXECUTION_ID, data={'status': 'FINISHED'})
-        global STAT_WATCHER_INSTANCE
-        if isinstance(STAT_WATCHER_INSTANCE, StatWatcher):
-            STAT_WATCHER_INSTANCE.stop()
+        bolt_api_client.write_or_archive(
+            deadline, bolt_api_client.insert_endpoint_totals, EXECUTION_ID, locust_wrapper.environment.stats
+        )
+        bolt_api_client.write_or_archive(
+            deadline, bolt_api_client.insert_time_distribution_results, EXECUTION_ID, locust_wrapper.environment.stats
+        )
+        # all results have to be saved (or archived) before execution is marked as finished
+        if not bolt_api_client.write_until_available(
+                deadline, bolt_api_client.update_execution, execution_id=EXECUTION_ID, data={'status': 'FINISHED'}):
+            wrap_logger.error(f'Execution {EXECUTION_ID} was not marked as finished')
         locust_wrapper.bolt_api_client.terminate()
+        wrap_instrumentation.report(wrap_logger)
         wrap_logger.info('End quit handler')
 
 
@@ -372,6 +593,9 @@ def test_start_handler(environment):
     Will be called before starting test runner
     """
     if WORKER_TYPE == 'master':
+        if locust_wrapper.recorder is not None:
+            # master stats are cleared when test starts, replay does the same
+            locust_wrapper.recorder.record(WRAP_TEST_START, timestamp=wrap_time.time())
         global STAT_WATCHER_INSTANCE
         STAT_WATCHER_INSTANCE = StatWatcher(
             1 if (TEST_DURATION / 500) < 1 else round(TEST_DURATION / 500),
@@ -379,7 +603,10 @@ def test_start_handler(environment):
         )
         execution_update_data = {'start_locust': locust_wrapper.start_execution.isoformat(), 'status': 'RUNNING'}
         wrap_logger.info(f'Setting execution details to: {execution_update_data}')
-        locust_wrapper.bolt_api_client.update_execution(execution_id=EXECUTION_ID, data=execution_update_data)
+        locust_wrapper.bolt_api_client.schedule_write(
+            WrapWriteLane.STATUS, locust_wrapper.bolt_api_client.update_execution,
+            execution_id=EXECUTION_ID, data=execution_update_data
+        )
         locust_wrapper.environment.runner.register_message("cpu_warning", locust_wrapper.cpu_warning)
 
 
@@ -394,11 +621,41 @@ def init_handler(environment, **kwargs):
         wrap_logger.info(f'Started locust tests with execution {EXECUTION_ID}')
         locust_wrapper.bolt_api_client.insert_execution_instance({'status': 'READY', 'instance_type': 'load_tests'})
         locust_wrapper.start_execution = wrap_datetime.datetime.now()
-        if not locust_wrapper.dataset:
-            locust_wrapper.dataset.append({locust_wrapper.start_execution.timestamp(): []})
-            locust_wrapper.dataset_timestamps.append(int(locust_wrapper.start_execution.timestamp()))
+        if locust_wrapper.recorder is not None:
+            locust_wrapper.recorder.record(WRAP_TEST_INIT, timestamp=locust_wrapper.start_execution.timestamp())
+        locust_wrapper.start_dataset(locust_wrapper.start_execution.timestamp())
         locust_wrapper.is_started = True
+        environment.runner.register_message('worker_resources', worker_resources_handler)
+        locust_wrapper.resource_sampler = WrapResourceSampler(
+            lambda sample: locust_wrapper.resources.add('master', sample), lambda: environment.runner.user_count
+        )
+        locust_wrapper.resource_sampler.start()
+        if WRAP_LOOP_LAG_MONITOR:
+            environment.runner.register_message('loop_lag_warning', loop_lag_warning_handler)
+            locust_wrapper.loop_lag_monitor = WrapLoopLagMonitor(
+                lambda lag_ms: locust_wrapper.loop_lag_warning('master', lag_ms)
+            )
+            locust_wrapper.loop_lag_monitor.start()
         wrap_logger.info('End start handler')
+    elif isinstance(environment.runner, WorkerRunner):
+        locust_wrapper.resource_sampler = WrapResourceSampler(
+            lambda sample: environment.runner.send_message('worker_resources', sample),
+            lambda: environment.runner.user_count
+        )
+        locust_wrapper.resource_sampler.start()
+        if WRAP_LOOP_LAG_MONITOR:
+            locust_wrapper.loop_lag_monitor = WrapLoopLagMonitor(
+                lambda lag_ms: environment.runner.send_message('loop_lag_warning', lag_ms)
+            )
+            locust_wrapper.loop_lag_monitor.start()
+    if not isinstance(environment.runner, MasterRunner):
+        # requests are measured where they are made (worker or local runner)
+        if WRAP_LATENCY_SKETCH:
+            locust_wrapper.latency_sketches = {}
+            if EXPECTED_INTERVAL_MS > 0:
+                locust_wrapper.corrected_latency_sketches = {}
+        if WRAP_SLOWEST_REQUESTS > 0:
+            locust_wrapper.slowest_requests = WrapSlowestRequests()
 
 
 @wrap_events.cpu_warning.add_listener
@@ -414,27 +671,72 @@ def cpu_warning_handler(environment, cpu_usage):
         locust_wrapper.environment.runner.send_message('cpu_warning')
 
 
+def worker_resources_handler(environment, msg, **kwargs):
+    """
+    Using when WORKER_TYPE is 'master' for receiving resource samples from slaves.
+    """
+    locust_wrapper.resources.add(msg.node_id, msg.data)
+
+
+def loop_lag_warning_handler(environment, msg, **kwargs):
+    """
+    Using when WORKER_TYPE is 'master' for receiving loop lag warnings from slaves.
+    """
+    locust_wrapper.loop_lag_warning(msg.node_id, msg.data)
+
+
+@wrap_instrumentation.instrumented('save_to_database')
 def save_to_database(data):
     """
     EventHook for sending aggregated results to database
     """
     if data is not None and data and WORKER_TYPE == 'master':
         try:
+            # stats stay untouched for retry, only uploaded metrics are marked
             locust_wrapper.bolt_api_client.insert_requests_distribution_results(data)
+        except WrapCircuitOpenError as ex:
+            wrap_logger.info(f'Aggregated results are kept in queue until API is available | {ex}')
+            locust_wrapper.queue_stats(data)
         except Exception as ex:
             wrap_logger.exception('Failed to insert aggregated results. Error ignored and execution continues.')
             wrap_logger.exception(ex)
-            return
-    try:
-        locust_wrapper.stats_queue.remove(data)
-    except ValueError:
-        wrap_logger.info(f'Stats do not exist in queue {len(locust_wrapper.stats_queue)}')
+            # add stats to queue for sending at the end of test
+            locust_wrapper.queue_stats(data)
 
 
 @wrap_events.worker_report.add_listener
+@wrap_instrumentation.instrumented('report_from_slave_handler')
 def report_from_slave_handler(client_id, data):
     """
     Using when WORKER_TYPE is 'master' for receiving stats from slaves.
     """
+    if locust_wrapper.recorder is not None:
+        locust_wrapper.recorder.record(WRAP_WORKER_REPORT, client_id=client_id, data=data)
     if locust_wrapper.is_started and WORKER_TYPE == 'master':
+        if 'loop_lag' in data:
+            locust_wrapper.loop_lag[client_id] = data['loop_lag']
+        if 'instrumentation' in data:
+            wrap_instrumentation.merge_summaries(
+                locust_wrapper.worker_instrumentation.setdefault(client_id, {}), data['instrumentation']
+            )
         locust_wrapper.push_event(data=data, event_type=WORKER_TYPE)
+
+
+@wrap_events.report_to_master.add_listener
+def report_to_master_handler(client_id, data):
+    """
+    Using when WORKER_TYPE is 'slave' for attaching wrapper data to reports sent to master.
+    """
+    if locust_wrapper.loop_lag_monitor is not None:
+        data['loop_lag'] = locust_wrapper.loop_lag_monitor.snapshot()
+    if instrumentation := wrap_instrumentation.sample():
+        data['instrumentation'] = instrumentation
+    if locust_wrapper.latency_sketches:
+        data['latency_sketches'] = wrap_serialize_sketches(locust_wrapper.latency_sketches)
+        locust_wrapper.latency_sketches = {}
+    if locust_wrapper.corrected_latency_sketches:
+        data['corrected_latency_sketches'] = wrap_serialize_sketches(locust_wrapper.corrected_latency_sketches)
+        locust_wrapper.corrected_latency_sketches = {}
+    if locust_wrapper.slowest_requests:
+        data['slowest_requests'] = locust_wrapper.slowest_requests.serialize()
+        locust_wrapper.slowest_requests.clear()
@@ -17,8 +17,8 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-from statistics import median
 from bolt_utils.bolt_logger import setup_custom_logger as wrap_setup_custom_logger
+from bolt_utils.bolt_aggregation import histogram_medians
 
 wrap_logger = wrap_setup_custom_logger(__name__)
 wrap_logger.propagate = False
@@ -27,13 +27,12 @@ wrap_logger.propagate = False
 def get_response_times_median_for_every_endpoint(response_times_per_endpoint):
     """
     In every endpoint stats there are: 'response_times': { 420: 2, 430: 3,}
-    To get median for single endpoint we need list like: [420, 420, 430, 430, 430]
+    Median is calculated directly from these counters, without expanding them to list (for all endpoints at once
+    with NumPy backend, see bolt_aggregation)
     """
-    for endpoint, value in response_times_per_endpoint.items():
-        responses = []
-        for time_value, counter in value.items():
-            responses.extend([time_value for i in range(counter)])
-        response_times_per_endpoint[endpoint] = median(responses)
+    medians = histogram_medians([value or {} for value in response_times_per_endpoint.values()])
+    for endpoint, median in zip(list(response_times_per_endpoint), medians):
+        response_times_per_endpoint[endpoint] = median
 
     return response_times_per_endpoint
 
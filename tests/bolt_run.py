@@ -37,8 +37,10 @@ import time
 
 import requests.exceptions
 
-from bolt_utils.bolt_exceptions import MonitoringError, MonitoringWaitingExpired
+from bolt_utils.bolt_exceptions import MonitoringError, MonitoringWaitingExpired, CircuitOpenError
+from bolt_utils.bolt_circuit_breaker import backoff_delay
 from bolt_utils.bolt_logger import setup_custom_logger
+from bolt_utils.bolt_profiler import ProfilerCapture
 from bolt_api_client import BoltAPIClient
 from bolt_supervisor import Supervisor
 from bolt_utils.bolt_enums import Status
@@ -57,6 +59,10 @@ EXECUTION_ID = os.getenv('BOLT_EXECUTION_ID')
 WORKER_TYPE = os.getenv('BOLT_WORKER_TYPE')
 MASTER_HOST = os.getenv('BOLT_MASTER_HOST')
 NFS_MOUNT = os.getenv('BOLT_NFS_MOUNT_1')
+# configuration of load tests in offline mode (without Bolt API)
+LOCUSTFILE_NAME = os.getenv('BOLT_LOCUSTFILE_NAME')
+TEST_DURATION = os.getenv('BOLT_TEST_DURATION')
+EXPECT_WORKERS = int(os.getenv('BOLT_EXPECT_WORKERS', '1'))
 
 # logger
 logger = setup_custom_logger(__name__)
@@ -67,7 +73,7 @@ logger.info(f'run token: {HASURA_TOKEN}')
 logger.info(f'worker type: {WORKER_TYPE}')
 logger.info(f'master host: {MASTER_HOST}')
 logger.info(f'nfs mount path: {NFS_MOUNT}')
-logger.info(os.environ)
+logger.debug(os.environ)
 
 SCENARIO_TYPE: str
 MAX_GQL_RETRY = 3
@@ -256,7 +262,7 @@ class Runner(object):
             _exit_with_status(EXIT_STATUS_ERROR)
         else:
             logger.info(f'Trying to detect scenario from arguments {sys.argv}')
-            if scenario in ('pre_start', 'post_stop', 'monitoring', 'load_tests'):
+            if scenario in ('pre_start', 'post_stop', 'monitoring', 'load_tests', 'upload_archive'):
                 logger.info(f'Detected scenario {scenario}')
                 global SCENARIO_TYPE  # additional set scenario as global variable
                 SCENARIO_TYPE = scenario
@@ -289,6 +295,28 @@ class Runner(object):
         logger.info(f'Start preparing arguments for slave.')
         return ['--worker', f'--master-host={MASTER_HOST}']  # additional arguments for slave
 
+    @staticmethod
+    def offline_execution_data(scenario_type):
+        """
+        Execution data of load tests in offline mode, built from envs (BOLT_LOCUSTFILE_NAME, BOLT_TEST_DURATION and
+        BOLT_EXPECT_WORKERS for master). Other arguments of locust are passed after scenario, e.g. `load_tests -u 10`
+        """
+        if scenario_type != 'load_tests':
+            _exit_with_status(EXIT_STATUS_ERROR, reason=f'Scenario {scenario_type} is not available in offline mode')
+        if not LOCUSTFILE_NAME or not TEST_DURATION:
+            _exit_with_status(
+                EXIT_STATUS_ERROR, reason='BOLT_LOCUSTFILE_NAME and BOLT_TEST_DURATION are required in offline mode')
+        return {'execution': [{
+            'status': Status.RUNNING.value,
+            'configuration': {
+                'instances': EXPECT_WORKERS,
+                'has_load_tests': True,
+                'configuration_parameters': [{
+                    'parameter_slug': 'load_tests_duration', 'value': TEST_DURATION, 'parameter': {'param_name': '-t'}
+                }],
+            },
+        }]}
+
     @staticmethod
     def flow_was_terminated_or_failed(execution_data):
         logger.info('Checking if the flow was terminated')
@@ -305,16 +333,25 @@ def main():
     logger.info('ARGS')
     logger.info(sys.argv)
     scenario_type = runner.scenario_detector()
+    if scenario_type == 'upload_archive':
+        # archives of results collected offline (or during API outage), paths can be passed as arguments
+        _import_and_run(
+            'bolt_utils.bolt_archive', 'upload', transport=bolt_api_client.gql_client.transport, paths=sys.argv[2:]
+        )
     execution_data = None
+    if bolt_api_client.archive.offline:
+        # there is no execution in API, load tests are configured with envs and arguments
+        execution_data = runner.offline_execution_data(scenario_type)
     retry_count = 0
     while execution_data is None and retry_count < MAX_GQL_RETRY:
         try:
             execution_data = bolt_api_client.get_execution(execution_id=EXECUTION_ID)
-        except requests.HTTPError as ex:
+        except (requests.RequestException, CircuitOpenError) as ex:
+            logger.info(f'Cannot get execution data | {ex}')
+            time.sleep(GQL_RETRY_TIMEOUT + backoff_delay(retry_count))
             retry_count += 1
-            time.sleep(GQL_RETRY_TIMEOUT)
     if not execution_data:
-        logger.error(f'Not able to gather execution data due to HTTP Error {ex}')
+        logger.error(f'Not able to gather execution data after {retry_count} retries')
         sys.exit(1)
     # if flow terminated we should exit from container as success (without retries)
     if runner.flow_was_terminated_or_failed(execution_data):
@@ -333,7 +370,8 @@ def main():
             has_load_tests=has_load_tests, monitoring_arguments=monitoring_arguments
         )
     elif scenario_type == 'load_tests':
-        runner.set_environments_for_load_tests(execution_data)
+        if not bolt_api_client.archive.offline:
+            runner.set_environments_for_load_tests(execution_data)
         # master/slave
         additional_arguments = None
         is_master, is_slave = runner.master_slave_detector()
@@ -349,6 +387,8 @@ def main():
         logger.info(f'Arguments (sys.argv) before {sys.argv}')
         sys.argv = runner.get_load_tests_arguments(execution_data, additional_arguments, is_master)
         logger.info(f'Arguments (sys.argv) after {sys.argv}')
+        # profiling can be triggered during test with SIGUSR1 or from start with BOLT_PROFILE_ON_START
+        ProfilerCapture(name=WORKER_TYPE or 'local').install()
         # monkey patch for returning 0 (success) status code
         sys.exit = lambda status: None
         locust_main()  # locust test runner
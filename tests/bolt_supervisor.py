@@ -23,11 +23,13 @@ import time
 import threading
 
 from bolt_api_client import BoltAPIClient
+from bolt_utils.bolt_circuit_breaker import backoff_delay
 from bolt_utils.bolt_enums import Status
 from bolt_utils.bolt_logger import setup_custom_logger
 
 
 EXECUTION_ID = os.getenv('BOLT_EXECUTION_ID')
+SUPERVISOR_INTERVAL = 7
 
 bolt_api_client = BoltAPIClient()
 logger = setup_custom_logger(__name__)
@@ -36,13 +38,16 @@ logger = setup_custom_logger(__name__)
 class Supervisor(object):
     @staticmethod
     def loop():
+        failures = 0
         while True:
             try:
                 execution = bolt_api_client.get_execution(EXECUTION_ID)
                 status = execution['execution'][0]['status']
             except Exception as ex:
                 logger.info(f'Supervisor exception. Cannot execute status for execution | {ex}')
+                failures += 1
             else:
+                failures = 0
                 logger.info(f'Supervisor. Status of flow is {status}')
                 if status in (Status.FAILED.value, Status.ERROR.value, Status.TERMINATED.value):
                     logger.info('Supervisor. Flow crashed/terminated. Call signal SIGTERM and exit')
@@ -50,7 +55,8 @@ class Supervisor(object):
                     os.kill(os.getpid(), signal.SIGTERM)
                     break
             finally:
-                time.sleep(7)
+                # back off while API is not available
+                time.sleep(SUPERVISOR_INTERVAL + (backoff_delay(failures - 1) if failures else 0))
 
     def run(self):
         logger.info('Starting supervisor ...')
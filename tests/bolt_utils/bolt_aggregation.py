@@ -0,0 +1,187 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Aggregation backends for quantiles of sampled requests and per endpoint histograms. NumPy backend (used when NumPy
+is importable) groups all endpoints in single sorted array and computes them with vectorized operations, pure
+Python backend is the fallback and is used for small inputs, where NumPy overhead is higher than the gain (see
+`bolt_benchmarks.bench_aggregation` for the crossover point). Both backends return the same values of the same
+types (checked by the benchmark for every size).
+"""
+
+import math
+import os
+from itertools import chain
+
+from bolt_utils.bolt_quantiles import PERCENTILES, histogram_median, histogram_percentiles as _histogram_percentiles
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# envs
+# auto - NumPy when it is importable and input is big enough, python - always pure Python, numpy - always NumPy
+AGGREGATION_BACKEND = os.getenv('BOLT_AGGREGATION_BACKEND', 'auto').lower()
+# sizes from which NumPy backend is used in 'auto' mode: sampled requests and buckets of all histograms
+NUMPY_MIN_VALUES = int(os.getenv('BOLT_NUMPY_MIN_VALUES', '300'))
+NUMPY_MIN_BUCKETS = int(os.getenv('BOLT_NUMPY_MIN_BUCKETS', '3000'))
+
+
+def _rank(quantile, size):
+    # nearest rank
+    return min(size - 1, max(0, int(math.ceil(quantile * size)) - 1))
+
+
+class PythonAggregation(object):
+    name = 'python'
+
+    @staticmethod
+    def quantiles(values, quantiles):
+        """
+        Values at nearest ranks of `quantiles` (0 - 1) of `values`
+        """
+        values = sorted(values)
+        return [values[_rank(quantile, len(values))] for quantile in quantiles]
+
+    @staticmethod
+    def histogram_medians(histograms):
+        """
+        Median of every histogram {value: count}
+        """
+        return [histogram_median(histogram) for histogram in histograms]
+
+    @staticmethod
+    def histogram_percentiles(histograms, totals, percentiles=PERCENTILES):
+        """
+        Percentiles of every locust histogram {response_time: count} with `totals` number of requests
+        """
+        return [
+            _histogram_percentiles(histogram, total, percentiles) for histogram, total in zip(histograms, totals)
+        ]
+
+
+class NumpyAggregation(object):
+    name = 'numpy'
+
+    @staticmethod
+    def quantiles(values, quantiles):
+        ranks = [_rank(quantile, len(values)) for quantile in quantiles]
+        if getattr(values, 'typecode', None) == 'd':
+            # typed array is used without copying, its values are floats already
+            return numpy.partition(numpy.frombuffer(values, dtype=numpy.float64), ranks)[ranks].tolist()
+        # values of other sequences are returned as they are (int stays int), as by Python backend
+        positions = numpy.argpartition(numpy.asarray(values, dtype=numpy.float64), ranks)[ranks]
+        return [values[position] for position in positions.tolist()]
+
+    @staticmethod
+    def _grouped(histograms):
+        """
+        Keys of all (not empty) histograms chained, positions of keys sorted by histogram and value, cumulative
+        counts before and after every sorted key and (start, end) of every histogram in sorted arrays.
+        Results are taken from original keys, so they have the same type (int or float) as with Python backend.
+        """
+        keys = list(chain.from_iterable(histograms))
+        sizes = numpy.fromiter(map(len, histograms), dtype=numpy.int64, count=len(histograms))
+        ends = numpy.cumsum(sizes)
+        values = numpy.array(keys, dtype=numpy.float64)
+        counts = numpy.fromiter(
+            chain.from_iterable(histogram.values() for histogram in histograms), dtype=numpy.int64, count=ends[-1]
+        )
+        groups = numpy.repeat(numpy.arange(len(histograms)), sizes)
+        lowest, highest = values.min(), values.max()
+        if numpy.array_equal(values, numpy.floor(values)) and (highest - lowest + 1) * len(histograms) < 2 ** 53:
+            # response times of locust are integers, single sort by (histogram, value) key is much faster
+            order = numpy.argsort(groups * int(highest - lowest + 1) + (values.astype(numpy.int64) - int(lowest)))
+        else:
+            order = numpy.lexsort((values, groups))
+        counts = counts[order]
+        cumulative = numpy.cumsum(counts)
+        return keys, order, cumulative - counts, cumulative, ends - sizes, ends
+
+    @classmethod
+    def histogram_medians(cls, histograms):
+        result = [0] * len(histograms)
+        indexes = [index for index, histogram in enumerate(histograms) if histogram]
+        if not indexes:
+            return result
+        keys, order, before, cumulative, starts, ends = cls._grouped([histograms[index] for index in indexes])
+        offsets = before[starts]
+        totals = cumulative[ends - 1] - offsets
+        # indexes of middle values in sorted list of all values of histogram
+        lower_index, upper_index = (totals - 1) // 2, totals // 2
+        # histograms with zero total are skipped below, their positions are only kept in range
+        lower = order[numpy.minimum(numpy.searchsorted(cumulative, offsets + lower_index, side='right'), ends - 1)]
+        upper = order[numpy.minimum(numpy.searchsorted(cumulative, offsets + upper_index, side='right'), ends - 1)]
+        for index, total, low_index, high_index, low, high in zip(
+            indexes, totals.tolist(), lower_index.tolist(), upper_index.tolist(), lower.tolist(), upper.tolist()
+        ):
+            if total:
+                result[index] = keys[low] if low_index == high_index else (keys[low] + keys[high]) / 2
+        return result
+
+    @classmethod
+    def histogram_percentiles(cls, histograms, totals, percentiles=PERCENTILES):
+        result = [dict.fromkeys(percentiles, 0) for _ in histograms]
+        indexes = [index for index, histogram in enumerate(histograms) if histogram]
+        if not indexes:
+            return result
+        keys, order, before, cumulative, starts, ends = cls._grouped([histograms[index] for index in indexes])
+        offsets = before[starts]
+        counted = cumulative[ends - 1] - offsets
+        totals = numpy.array([totals[index] for index in indexes], dtype=numpy.int64)
+        columns = []
+        for percent in percentiles:
+            # the highest value with enough requests from it to the highest value, the same as walking from
+            # the highest value in `bolt_quantiles.histogram_percentiles`
+            thresholds = (totals * (percent / 100)).astype(numpy.int64)
+            found = numpy.searchsorted(before, offsets + counted - totals + thresholds, side='right') - 1
+            found = numpy.minimum(found, ends - 1)
+            # position of key or -1 when percentile is not found (0 is returned)
+            columns.append(numpy.where(found >= starts, order[numpy.maximum(found, 0)], -1))
+        for index, row in zip(indexes, numpy.array(columns).T.tolist()):
+            result[index] = {
+                percent: keys[position] if position >= 0 else 0 for percent, position in zip(percentiles, row)
+            }
+        return result
+
+
+def backend(size, min_size):
+    """
+    Backend for input of `size` values, NumPy is used (in 'auto' mode) from `min_size` values
+    """
+    if numpy is None or AGGREGATION_BACKEND == 'python':
+        return PythonAggregation
+    if AGGREGATION_BACKEND == 'numpy' or size >= min_size:
+        return NumpyAggregation
+    return PythonAggregation
+
+
+def quantiles(values, quantiles):
+    return backend(len(values), NUMPY_MIN_VALUES).quantiles(values, quantiles)
+
+
+def histogram_medians(histograms):
+    return backend(sum(map(len, histograms)), NUMPY_MIN_BUCKETS).histogram_medians(histograms)
+
+
+def histogram_percentiles(histograms, totals, percentiles=PERCENTILES):
+    return backend(sum(map(len, histograms)), NUMPY_MIN_BUCKETS).histogram_percentiles(
+        histograms, totals, percentiles
+    )
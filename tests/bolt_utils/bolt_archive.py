@@ -0,0 +1,214 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import glob
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from graphql import parse
+
+from bolt_utils.bolt_coalescer import merge_operations
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+EXECUTION_ID = os.getenv('BOLT_EXECUTION_ID')
+WORKER_TYPE = os.getenv('BOLT_WORKER_TYPE')
+# results are only archived (not sent) in offline mode, which is also used when BOLT_GRAPHQL_URL is not set
+OFFLINE = os.getenv('BOLT_OFFLINE', 'false').lower() in ('1', 'true', 'yes') or not os.getenv('BOLT_GRAPHQL_URL')
+# archive results which were not sent because API was not available until the end of test (BOLT_FINAL_WRITES_TIMEOUT)
+ARCHIVE_ON_OUTAGE = os.getenv('BOLT_ARCHIVE_ON_OUTAGE', 'false').lower() in ('1', 'true', 'yes')
+# directory of archives, temporary directory (lost with container) is used only in offline mode
+ARCHIVE_DIR = os.getenv('BOLT_ARCHIVE_DIR') or os.getenv('BOLT_NFS_MOUNT_1')
+ARCHIVE_PATH = os.getenv('BOLT_ARCHIVE_PATH') or os.path.join(
+    ARCHIVE_DIR or tempfile.gettempdir(), f'bolt_archive_{EXECUTION_ID or "local"}_{WORKER_TYPE or "local"}.db'
+)
+PERSISTENT_ARCHIVE = bool(os.getenv('BOLT_ARCHIVE_PATH') or ARCHIVE_DIR)
+ARCHIVE_UPLOAD_BATCH = int(os.getenv('BOLT_ARCHIVE_UPLOAD_BATCH', '50'))
+
+logger = setup_custom_logger(__name__)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        operation TEXT NOT NULL,
+        query TEXT NOT NULL,
+        variables TEXT NOT NULL,
+        uploaded_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS operations_pending ON operations (uploaded_at, id);
+    CREATE VIEW IF NOT EXISTS archived_requests AS
+        SELECT
+            operations.id AS operation_id,
+            json_extract(row.value, '$.timestamp') AS timestamp,
+            json_extract(row.value, '$.identifier') AS identifier,
+            json_extract(row.value, '$.method') AS method,
+            json_extract(row.value, '$.name') AS name,
+            json_extract(row.value, '$.num_requests') AS num_requests,
+            json_extract(row.value, '$.num_failures') AS num_failures,
+            json_extract(row.value, '$.average_response_time') AS average_response_time,
+            json_extract(row.value, '$.min_response_time') AS min_response_time,
+            json_extract(row.value, '$.max_response_time') AS max_response_time,
+            json_extract(row.value, '$.total_content_length') AS total_content_length,
+            json_extract(row.value, '$.median_response_time') AS median_response_time,
+            json_extract(row.value, '$.requests_per_second') AS requests_per_second,
+            json_extract(row.value, '$.successes_per_tick') AS successes_per_tick
+        FROM operations, json_each(operations.variables, '$.requests') AS row
+        WHERE operations.operation LIKE '%insert_execution_requests%';
+    CREATE VIEW IF NOT EXISTS archived_errors AS
+        SELECT
+            operations.id AS operation_id,
+            json_extract(row.value, '$.timestamp') AS timestamp,
+            json_extract(row.value, '$.identifier') AS identifier,
+            json_extract(row.value, '$.method') AS method,
+            json_extract(row.value, '$.name') AS name,
+            json_extract(row.value, '$.exception_data') AS exception_data,
+            json_extract(row.value, '$.number_of_occurrences') AS number_of_occurrences
+        FROM operations, json_each(operations.variables, '$.errors') AS row
+        WHERE operations.operation LIKE '%insert_execution_errors%';
+'''
+
+
+class ResultsArchive(object):
+    """
+    Local SQLite archive of result mutations which were not sent to API. Every operation is kept as query and
+    JSON variables, so it can be uploaded later as it is. Rows of ticks and errors can be queried locally
+    with `archived_requests` and `archived_errors` views. File is created with the first archived operation.
+    Results are archived in offline mode, or after `start_outage_archiving` when API was not available until
+    the end of test.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH, offline=OFFLINE, on_outage=ARCHIVE_ON_OUTAGE, persistent=PERSISTENT_ARCHIVE):
+        self.path = path
+        self.offline = offline
+        self.on_outage = on_outage
+        self.persistent = persistent
+        self.archiving = False
+        self.archived = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def start_outage_archiving(self):
+        """
+        Archive results from now on, instead of sending them. Returns False if archiving on outage is disabled or
+        archive directory is not configured (archive in temporary directory would be lost with container).
+        """
+        if not self.on_outage:
+            return False
+        if not self.persistent:
+            logger.error('Results are not archived, BOLT_ARCHIVE_DIR (or BOLT_ARCHIVE_PATH) is not set')
+            return False
+        if not self.archiving:
+            logger.warning(f'API is not available, results are archived in {self.path}')
+            self.archiving = True
+        return True
+
+    def add(self, operation, query, variables):
+        """
+        Archive operation with variables already encoded to JSON
+        """
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                connection.execute(
+                    'INSERT INTO operations (created_at, operation, query, variables) VALUES (?, ?, ?, ?)',
+                    (time.time(), operation, query, variables)
+                )
+            self.archived += 1
+
+    def pending(self, after_id, limit):
+        with self._lock:
+            return self.connection().execute(
+                'SELECT id, query, variables FROM operations WHERE uploaded_at IS NULL AND id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)
+            ).fetchall()
+
+    def mark_uploaded(self, ids):
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                connection.executemany(
+                    'UPDATE operations SET uploaded_at = ? WHERE id = ?', [(time.time(), i) for i in ids]
+                )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def upload_batch(transport, operations):
+    """
+    Send archived operations as single merged mutation, or one by one if merged one failed.
+    Returns ids of uploaded operations.
+    """
+    documents = [(parse(query), json.loads(variables)) for _, query, variables in operations]
+    if len(operations) > 1:
+        document, variable_values, _ = merge_operations(documents)
+        result = transport.execute(document, variable_values=variable_values)
+        if not result.errors:
+            return [operation_id for operation_id, _, _ in operations]
+        logger.warning(f'Merged upload of {len(operations)} operations failed, uploading one by one | {result.errors}')
+    uploaded = []
+    for (operation_id, _, _), (document, variable_values) in zip(operations, documents):
+        result = transport.execute(document, variable_values=variable_values)
+        if result.errors:
+            logger.error(f'Archived operation {operation_id} was rejected | {result.errors}')
+        else:
+            uploaded.append(operation_id)
+    return uploaded
+
+
+def upload(transport, paths=None, batch_size=ARCHIVE_UPLOAD_BATCH):
+    """
+    Upload pending operations from archives (by default all archives of execution in archive directory)
+    """
+    # uploaded operations must not be archived again
+    transport.archive = None
+    paths = paths or glob.glob(os.path.join(ARCHIVE_DIR or tempfile.gettempdir(), f'bolt_archive_{EXECUTION_ID}_*.db'))
+    for path in paths:
+        archive = ResultsArchive(path)
+        total = rejected = 0
+        try:
+            last_id = 0
+            while True:
+                # rejected operations stay pending for next upload
+                operations = archive.pending(last_id, batch_size)
+                if not operations:
+                    break
+                last_id = operations[-1][0]
+                uploaded = upload_batch(transport, operations)
+                archive.mark_uploaded(uploaded)
+                total += len(uploaded)
+                rejected += len(operations) - len(uploaded)
+        finally:
+            archive.close()
+        logger.info(f'Uploaded {total} operations from archive {path}, rejected {rejected}')
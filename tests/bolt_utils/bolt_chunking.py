@@ -0,0 +1,107 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bolt_utils.bolt_circuit_breaker import backoff_delay
+from bolt_utils.bolt_exceptions import ChunkUploadError, CircuitOpenError
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+GRAPHQL_MAX_PAYLOAD_BYTES = int(os.getenv('BOLT_GRAPHQL_MAX_PAYLOAD_BYTES', str(1024 * 1024)))
+CHUNK_ROWS = int(os.getenv('BOLT_CHUNK_ROWS', '1000'))
+CHUNK_MIN_ROWS = int(os.getenv('BOLT_CHUNK_MIN_ROWS', '10'))
+CHUNK_MAX_ROWS = int(os.getenv('BOLT_CHUNK_MAX_ROWS', '10000'))
+CHUNK_TARGET_LATENCY_SECONDS = float(os.getenv('BOLT_CHUNK_TARGET_LATENCY_SECONDS', '2'))
+CHUNK_CONCURRENCY = int(os.getenv('BOLT_CHUNK_CONCURRENCY', '4'))
+CHUNK_RETRIES = int(os.getenv('BOLT_CHUNK_RETRIES', '2'))
+
+logger = setup_custom_logger(__name__)
+
+
+class ChunkSizer(object):
+    """
+    Number of rows per chunk adapted to API (AIMD): grows by `increase` rows after chunk uploaded faster than
+    `target_latency`, is halved after slow or failed upload.
+    """
+
+    def __init__(self, rows=CHUNK_ROWS, min_rows=CHUNK_MIN_ROWS, max_rows=CHUNK_MAX_ROWS,
+                 target_latency=CHUNK_TARGET_LATENCY_SECONDS, increase=None):
+        self.rows = rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_latency = target_latency
+        self.increase = increase or max(1, rows // 10)
+        self._lock = threading.Lock()
+
+    def record(self, latency, failed=False):
+        with self._lock:
+            if failed or latency > self.target_latency:
+                self.rows = max(self.min_rows, self.rows // 2)
+            else:
+                self.rows = min(self.max_rows, self.rows + self.increase)
+
+    def chunk_rows(self, row_bytes, max_bytes=GRAPHQL_MAX_PAYLOAD_BYTES):
+        """
+        Rows per chunk limited by current size and by payload limit for rows of `row_bytes` size
+        """
+        return max(self.min_rows, min(self.rows, max_bytes // max(row_bytes, 1)))
+
+
+def split(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def upload_chunks(send, chunks, sizer, concurrency=CHUNK_CONCURRENCY, retries=CHUNK_RETRIES):
+    """
+    Upload chunks with `send(chunk)` concurrently (at most `concurrency` at once), failed chunk is retried with
+    backoff. Raises ChunkUploadError if any chunk was not uploaded, or CircuitOpenError when API is not available.
+    """
+    def upload(chunk):
+        for attempt in range(retries + 1):
+            started = time.monotonic()
+            try:
+                result = send(chunk)
+                error = result.errors
+            except CircuitOpenError:
+                raise
+            except Exception as ex:
+                error = ex
+            sizer.record(time.monotonic() - started, failed=bool(error))
+            if not error:
+                return result
+            logger.warning(f'Chunk upload failed (attempt {attempt + 1}/{retries + 1}) | {error}')
+            if attempt < retries:
+                time.sleep(backoff_delay(attempt))
+        raise ChunkUploadError(error)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(chunks)))) as pool:
+        futures = [pool.submit(upload, chunk) for chunk in chunks]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    for error in errors:
+        # caller keeps tick for retry when API is available again
+        if isinstance(error, CircuitOpenError):
+            raise error
+    if errors:
+        raise ChunkUploadError(f'{len(errors)} of {len(chunks)} chunks were not uploaded | {errors[0]}')
+    return [future.result() for future in futures]
@@ -0,0 +1,113 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import random
+import threading
+import time
+
+from bolt_utils.bolt_enums import BreakerState
+from bolt_utils.bolt_exceptions import CircuitOpenError
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BOLT_BREAKER_FAILURE_THRESHOLD', '5'))
+BACKOFF_BASE_SECONDS = float(os.getenv('BOLT_BACKOFF_BASE_SECONDS', '1'))
+BACKOFF_MAX_SECONDS = float(os.getenv('BOLT_BACKOFF_MAX_SECONDS', '60'))
+
+logger = setup_custom_logger(__name__)
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """
+    Exponential backoff with full jitter for given attempt (starting from 0)
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to failing service. After `failure_threshold` consecutive failures circuit is opened and calls
+    fail fast with CircuitOpenError. After backoff delay single probe call is allowed (half-open state),
+    its success closes circuit, its failure opens circuit again with longer delay.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.open_attempts = 0
+        self.open_until = 0
+        self.skipped_calls = 0
+        self.transitions = 0
+        self._probe_in_progress = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        logger.warning(f'Circuit breaker {self.name}: {self.state.value} -> {state.value} '
+                       f'(failures {self.failures}, skipped calls {self.skipped_calls})')
+        self.state = state
+        self.transitions += 1
+
+    def before_call(self):
+        with self._lock:
+            if self.state == BreakerState.OPEN and time.monotonic() >= self.open_until:
+                self._transition(BreakerState.HALF_OPEN)
+            if self.state == BreakerState.CLOSED:
+                return
+            if self.state == BreakerState.HALF_OPEN and not self._probe_in_progress:
+                self._probe_in_progress = True
+                return
+            self.skipped_calls += 1
+        raise CircuitOpenError(f'Circuit breaker {self.name} is {self.state.value}')
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_attempts = 0
+            self._probe_in_progress = False
+            if self.state != BreakerState.CLOSED:
+                self._transition(BreakerState.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_progress = False
+            if self.state == BreakerState.HALF_OPEN or (
+                    self.state == BreakerState.CLOSED and self.failures >= self.failure_threshold):
+                self.open_until = time.monotonic() + max(backoff_delay(self.open_attempts), BACKOFF_BASE_SECONDS)
+                self.open_attempts += 1
+                self._transition(BreakerState.OPEN)
+
+    def open_time_left(self):
+        """
+        Seconds until the next call is allowed (0 when circuit is not open)
+        """
+        if self.state != BreakerState.OPEN:
+            return 0
+        return max(0, self.open_until - time.monotonic())
+
+    def stats(self):
+        return {
+            'state': self.state.value,
+            'failures': self.failures,
+            'skipped_calls': self.skipped_calls,
+            'transitions': self.transitions,
+        }
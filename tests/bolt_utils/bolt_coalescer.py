@@ -0,0 +1,209 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import copy
+import os
+import threading
+
+from graphql.execution import ExecutionResult
+from graphql.language.ast import DocumentNode, NameNode, OperationDefinitionNode, SelectionSetNode
+from graphql.language.visitor import Visitor, visit
+
+from bolt_utils.bolt_enums import BreakerState
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+COALESCE_MAX_OPERATIONS = int(os.getenv('BOLT_COALESCE_MAX_OPERATIONS', '10'))
+# time for which scheduler waits for more writes to send them together
+COALESCE_WINDOW_MS = int(os.getenv('BOLT_COALESCE_WINDOW_MS', '200'))
+
+logger = setup_custom_logger(__name__)
+
+
+class PrefixVariables(Visitor):
+    def __init__(self, prefix):
+        super().__init__()
+        self.prefix = prefix
+
+    def enter_variable(self, node, *args):
+        node.name = NameNode(value=f'{self.prefix}{node.name.value}')
+
+
+def is_mergeable(document):
+    return len(document.definitions) == 1 and isinstance(document.definitions[0], OperationDefinitionNode)
+
+
+def merge_operations(operations):
+    """
+    Merge operations (of the same type) into single document, variables and root fields of every operation are
+    prefixed with its index. Returns document, variables and {alias: (operation index, original key)}.
+    """
+    variable_definitions = []
+    selections = []
+    variable_values = {}
+    aliases = {}
+    for index, (document, variables) in enumerate(operations):
+        prefix = f'op{index}_'
+        definition = copy.deepcopy(document.definitions[0])
+        visit(definition, PrefixVariables(prefix))
+        variable_definitions.extend(definition.variable_definitions or ())
+        for field in definition.selection_set.selections:
+            key = field.alias.value if field.alias else field.name.value
+            field.alias = NameNode(value=f'{prefix}{key}')
+            aliases[field.alias.value] = (index, key)
+            selections.append(field)
+        variable_values.update({f'{prefix}{name}': value for name, value in (variables or {}).items()})
+    document = DocumentNode(definitions=(OperationDefinitionNode(
+        operation=operations[0][0].definitions[0].operation,
+        variable_definitions=tuple(variable_definitions),
+        directives=(),
+        selection_set=SelectionSetNode(selections=tuple(selections)),
+    ),))
+    return document, variable_values, aliases
+
+
+class PendingOperation(object):
+    __slots__ = ('document', 'variables', 'result', 'error', 'done')
+
+    def __init__(self, document, variables):
+        self.document = document
+        self.variables = variables
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class OperationCoalescer(object):
+    """
+    Runs batch of jobs concurrently. Operations executed by these jobs are collected until every job is either
+    waiting for its operation or finished, then they are sent as single aliased multi-root document and the
+    response is split back to jobs. If merged operation fails with GraphQL errors (Hasura executes it in single
+    transaction), operations are sent again one by one, so a bad operation does not fail the others.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running = 0
+        self.operations = 0
+        self.round_trips = 0
+
+    def is_coalescing(self):
+        return getattr(self._local, 'active', False)
+
+    def submit(self, document, variable_values=None):
+        """
+        Called by transport in job thread instead of sending operation, waits for result of operation
+        """
+        operation = PendingOperation(document, variable_values)
+        with self._condition:
+            self._pending.append(operation)
+            self._running -= 1
+            self._condition.notify_all()
+            while not operation.done:
+                self._condition.wait()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _call(self, func):
+        self._local.active = True
+        try:
+            func()
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+    def run(self, funcs):
+        """
+        Run functions (which must handle their exceptions) and send their operations together
+        """
+        with self._condition:
+            self._running = len(funcs)
+        threads = [threading.Thread(target=self._call, args=(func,), daemon=True) for func in funcs]
+        for thread in threads:
+            thread.start()
+        while True:
+            with self._condition:
+                while self._running > 0:
+                    self._condition.wait()
+                operations, self._pending = self._pending, []
+            if not operations:
+                break
+            self._send(operations)
+            with self._condition:
+                self._running += len(operations)
+                for operation in operations:
+                    operation.done = True
+                self._condition.notify_all()
+        for thread in threads:
+            thread.join()
+
+    def _send_single(self, operation):
+        self.round_trips += 1
+        try:
+            operation.result = self.transport.execute(operation.document, variable_values=operation.variables)
+        except Exception as ex:
+            operation.error = ex
+
+    def _send(self, operations):
+        self.operations += len(operations)
+        groups = {}
+        for operation in operations:
+            # operations are not merged while API is failing, so every one of them fails (and is retried) separately
+            if is_mergeable(operation.document) and self.transport.circuit_breaker.state == BreakerState.CLOSED:
+                groups.setdefault(operation.document.definitions[0].operation, []).append(operation)
+            else:
+                self._send_single(operation)
+        for group in groups.values():
+            if len(group) == 1:
+                self._send_single(group[0])
+                continue
+            document, variable_values, aliases = merge_operations(
+                [(operation.document, operation.variables) for operation in group]
+            )
+            self.round_trips += 1
+            try:
+                result = self.transport.execute(document, variable_values=variable_values)
+            except Exception as ex:
+                for operation in group:
+                    operation.error = ex
+                continue
+            if result.errors:
+                logger.warning(f'Merged operation failed, sending {len(group)} operations separately | {result.errors}')
+                for operation in group:
+                    self._send_single(operation)
+                continue
+            data = [{} for _ in group]
+            for alias, value in (result.data or {}).items():
+                index, key = aliases[alias]
+                data[index][key] = value
+            for operation, operation_data in zip(group, data):
+                operation.result = ExecutionResult(data=operation_data, errors=None)
+
+    def stats(self):
+        """
+        Number of coalesced operations and round trips used for them since previous call
+        """
+        stats = {'operations': self.operations, 'round_trips': self.round_trips}
+        self.operations = self.round_trips = 0
+        return stats
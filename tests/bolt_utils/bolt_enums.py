@@ -29,3 +29,18 @@ class Status(enum.Enum):
     TERMINATED = 'TERMINATED'
     FINISHED = 'FINISHED'
     MONITORING = 'MONITORING'
+
+
+class WriteLane(enum.IntEnum):
+    """
+    Priority lanes of writes to Bolt API, lower value is sent first
+    """
+    STATUS = 0
+    AGGREGATES = 1
+    DETAILS = 2
+
+
+class BreakerState(enum.Enum):
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
@@ -0,0 +1,154 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import heapq
+import itertools
+import os
+import re
+
+# envs
+MAX_ERROR_KEYS = int(os.getenv('BOLT_MAX_ERROR_KEYS', '100'))
+ERROR_KEY_CACHE_SIZE = int(os.getenv('BOLT_ERROR_KEY_CACHE_SIZE', '4096'))
+
+OBJECT_ADDRESS_PATTERN = re.compile(r' object at 0x\S*')
+OTHER_ERRORS = 'other'
+
+_error_keys_cache = {}
+
+
+def error_key(method, name, error):
+    """
+    Build normalized key for error (without trash like object addresses). Normalized keys are cached by raw
+    values, cache is cleared when it reaches `ERROR_KEY_CACHE_SIZE` entries.
+    """
+    raw = (method, name, error)
+    try:
+        return _error_keys_cache[raw]
+    except KeyError:
+        key = OBJECT_ADDRESS_PATTERN.sub('', f'{method}/{name}/{error}')
+        if len(_error_keys_cache) >= ERROR_KEY_CACHE_SIZE:
+            _error_keys_cache.clear()
+        _error_keys_cache[raw] = key
+        return key
+
+
+class ErrorRecord(object):
+    """
+    Error tracked by aggregator, converted to dict only when errors are serialized
+    """
+    __slots__ = ('method', 'name', 'error')
+
+    def __init__(self, method, name, error):
+        self.method = method
+        self.name = name
+        self.error = error
+
+    def to_dict(self):
+        return {'method': self.method, 'name': self.name, 'error': self.error}
+
+
+class ErrorAggregator(object):
+    """
+    Bounded aggregation of errors based on space-saving (top-K heavy hitters) algorithm. Keeps at most
+    `capacity` errors, occurrences which cannot be assigned to one of them are reported in 'other' bucket.
+    Errors are kept as `ErrorRecord` and converted with `formatter` in `values`. The least frequent error is found
+    with min-heap of (count, order of adding, key), which has one entry for every tracked error. Counts only grow, so
+    entries of heap are lower bounds, outdated ones are pushed again with current count when they reach the top.
+    """
+
+    def __init__(self, capacity=MAX_ERROR_KEYS, count_field='number_of_occurrences', other_entry=None,
+                 formatter=ErrorRecord.to_dict):
+        if capacity < 1:
+            # space-saving has to track at least one error to replace (BOLT_MAX_ERROR_KEYS)
+            raise ValueError(f'Capacity of error aggregator must be at least 1, got {capacity}')
+        self.capacity = capacity
+        self.count_field = count_field
+        self.other_entry = other_entry or {}
+        self.formatter = formatter
+        self.entries = {}
+        self.total = 0
+        self._counts = {}
+        self._overestimations = {}
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return self.total > 0
+
+    def add(self, key, count, entry_factory):
+        """
+        Count `count` occurrences of error `key`. `entry_factory` (returning `ErrorRecord`) is called only when error
+        is not tracked yet.
+        """
+        self.total += count
+        if key in self._counts:
+            self._counts[key] += count
+            return
+        overestimation = 0
+        if len(self._counts) >= self.capacity:
+            # replace the least frequent error, new one inherits its count as possible overestimation
+            evicted = self._pop_least_frequent()
+            overestimation = self._counts.pop(evicted)
+            del self._overestimations[evicted]
+            del self.entries[evicted]
+        self._counts[key] = overestimation + count
+        self._overestimations[key] = overestimation
+        self.entries[key] = entry_factory()
+        heapq.heappush(self._heap, (overestimation + count, next(self._order), key))
+
+    def _pop_least_frequent(self):
+        """
+        Remove the least frequent error from heap and return its key (the earliest added one of equally frequent)
+        """
+        while True:
+            count, order, key = self._heap[0]
+            current = self._counts[key]
+            if current == count:
+                heapq.heappop(self._heap)
+                return key
+            heapq.heapreplace(self._heap, (current, order, key))
+
+    def values(self):
+        """
+        Return list of errors with guaranteed number of occurrences and 'other' bucket for the rest of them
+        """
+        errors = []
+        counted = 0
+        for key, record in self.entries.items():
+            occurrences = self._counts[key] - self._overestimations[key]
+            if occurrences <= 0:
+                continue
+            entry = self.formatter(record)
+            entry[self.count_field] = occurrences
+            counted += occurrences
+            errors.append(entry)
+        if self.total > counted:
+            errors.append({**self.other_entry, self.count_field: self.total - counted})
+        return errors
+
+    def clear(self):
+        self.entries = {}
+        self.total = 0
+        self._counts = {}
+        self._overestimations = {}
+        self._heap = []
+        self._order = itertools.count()
@@ -0,0 +1,136 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+import os
+import random
+from array import array
+
+from bolt_utils.bolt_aggregation import quantiles
+
+# envs
+# fraction of requests which are candidates for reservoir (1 - all requests)
+EVENT_SAMPLING_RATE = float(os.getenv('BOLT_EVENT_SAMPLING_RATE', '1'))
+# number of full request records kept per interval (0 - no limit)
+EVENT_RESERVOIR_SIZE = int(os.getenv('BOLT_EVENT_RESERVOIR_SIZE', '0'))
+
+SAMPLED_PERCENTILES = (50, 90, 99)
+# z-score for 95% confidence bounds
+CONFIDENCE_Z = 1.96
+
+
+class EventSample(object):
+    """
+    Requests of single interval. Counters are exact for every request, while requests are kept only in sampling
+    mode (`is_sampled`), in uniform reservoir (algorithm R) of `reservoir_size` elements. Sampled requests are stored
+    in columns (typed arrays and lists of shared strings) instead of object per request, they are only used for
+    percentiles.
+    """
+    __slots__ = (
+        'sampling_rate', 'reservoir_size', 'seen', 'candidates', 'successes', 'failures', 'total_response_time',
+        'total_response_length', 'exceptions', 'request_types', 'names', 'response_times', 'response_lengths',
+        'errors', 'timestamps',
+    )
+
+    def __init__(self, sampling_rate=EVENT_SAMPLING_RATE, reservoir_size=EVENT_RESERVOIR_SIZE):
+        self.sampling_rate = sampling_rate
+        self.reservoir_size = reservoir_size
+        self.seen = 0
+        self.candidates = 0
+        self.successes = 0
+        self.failures = 0
+        self.total_response_time = 0.0
+        self.total_response_length = 0
+        self.exceptions = set()
+        # columns of sampled requests, `errors` has text of exception or None for successful request
+        self.request_types = []
+        self.names = []
+        self.response_times = array('d')
+        self.response_lengths = array('q')
+        self.errors = []
+        self.timestamps = array('q')
+
+    @property
+    def is_sampled(self):
+        return self.sampling_rate < 1 or self.reservoir_size > 0
+
+    @property
+    def sampled(self):
+        return len(self.response_times)
+
+    def offer(self, request_type, name, response_time, response_length, exception, timestamp):
+        """
+        Count request and keep it if it was chosen for reservoir (only in sampling mode). `exception` is text of
+        exception or None.
+        """
+        self.seen += 1
+        response_length = response_length or 0
+        if exception is None:
+            self.successes += 1
+        else:
+            self.failures += 1
+            self.exceptions.add(exception)
+        self.total_response_time += response_time
+        self.total_response_length += response_length
+        if not self.is_sampled or self.sampling_rate < 1 and random.random() >= self.sampling_rate:
+            return
+        self.candidates += 1
+        if self.reservoir_size <= 0 or len(self.response_times) < self.reservoir_size:
+            self.request_types.append(request_type)
+            self.names.append(name)
+            self.response_times.append(response_time)
+            self.response_lengths.append(response_length)
+            self.errors.append(exception)
+            self.timestamps.append(timestamp)
+        else:
+            index = random.randrange(self.candidates)
+            if index < self.reservoir_size:
+                self.request_types[index] = request_type
+                self.names[index] = name
+                self.response_times[index] = response_time
+                self.response_lengths[index] = response_length
+                self.errors[index] = exception
+                self.timestamps[index] = timestamp
+
+    def sampled_percentiles(self, percentiles=SAMPLED_PERCENTILES):
+        """
+        Estimate response time percentiles from sampled records with 95% confidence bounds based on binomial
+        rank error: {'p50': [low, estimate, high], ...}
+        """
+        size = len(self.response_times)
+        if not size:
+            return {}
+        bounds = []
+        for percent in percentiles:
+            quantile = percent / 100.0
+            rank_error = CONFIDENCE_Z * math.sqrt(quantile * (1 - quantile) / size)
+            bounds += (max(0.0, quantile - rank_error), quantile, min(1.0, quantile + rank_error))
+        values = quantiles(self.response_times, bounds)
+        return {f'p{percent}': values[index * 3:index * 3 + 3] for index, percent in enumerate(percentiles)}
+
+    def summary(self):
+        """
+        Sampling details attached to interval stats
+        """
+        return {
+            'seen': self.seen,
+            'sampled': self.sampled,
+            'sampling_fraction': round(self.sampled / self.seen, 6) if self.seen else 0,
+            'percentiles': self.sampled_percentiles(),
+        }
@@ -39,3 +39,15 @@ class MonitoringError(Exception):
 
 class MonitoringWaitingExpired(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class ChunkUploadError(Exception):
+    pass
+
+
+class OfflineModeError(Exception):
+    pass
@@ -0,0 +1,147 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import time
+
+from functools import wraps
+
+# envs
+INSTRUMENTATION = os.getenv('BOLT_INSTRUMENTATION', 'true').lower() in ('1', 'true', 'yes')
+
+# durations are kept in histogram with power of two buckets in microseconds: bucket `i` holds durations < 2**i us
+HISTOGRAM_BUCKETS = 32
+INSTRUMENTATION_PERCENTILES = (50, 99)
+
+counters = {}
+_previous = {}
+
+
+class TimingCounter(object):
+    __slots__ = ('calls', 'total', 'max', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, duration):
+        self.calls += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.histogram[min(int(duration * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+
+def instrumented(name):
+    """
+    Count calls and durations of decorated function under `name`. Does nothing when instrumentation is disabled.
+    """
+    def decorator(func):
+        if not INSTRUMENTATION:
+            return func
+        counter = counters.setdefault(name, TimingCounter())
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counter.record(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def summary(calls, total, histogram):
+    """
+    Return number of calls, total time and percentiles (upper bounds of histogram buckets) of calls
+    """
+    result = {'calls': calls, 'total_ms': round(total * 1000, 3)}
+    processed = 0
+    bucket = 0
+    for percent in INSTRUMENTATION_PERCENTILES:
+        while bucket < HISTOGRAM_BUCKETS and processed + histogram[bucket] < calls * percent / 100:
+            processed += histogram[bucket]
+            bucket += 1
+        # upper bound of bucket
+        result[f'p{percent}_ms'] = (2 ** bucket) / 1000
+    return result
+
+
+def snapshot():
+    """
+    Return (calls, total, histogram) of every instrumented function, to be passed to `summary_since`
+    """
+    return {name: (counter.calls, counter.total, counter.histogram.copy()) for name, counter in counters.items()}
+
+
+def summary_since(previous, current=None):
+    """
+    Return summary of calls made between `previous` and `current` (now by default) snapshots for every instrumented
+    function
+    """
+    if current is None:
+        current = snapshot()
+    result = {}
+    for name, (calls, total, histogram) in current.items():
+        previous_calls, previous_total, previous_histogram = previous.get(name, (0, 0.0, [0] * HISTOGRAM_BUCKETS))
+        if calls > previous_calls:
+            result[name] = summary(
+                calls - previous_calls, total - previous_total, [c - p for c, p in zip(histogram, previous_histogram)]
+            )
+    return result
+
+
+def sample():
+    """
+    Return summary of calls made since previous sample for every instrumented function
+    """
+    current = snapshot()
+    result = summary_since(_previous, current)
+    _previous.update(current)
+    return result
+
+
+def merge_summaries(summaries, other):
+    """
+    Add summaries of calls (e.g. from following reports of worker) to `summaries`, percentiles are the highest ones
+    """
+    for name, entry in other.items():
+        current = summaries.get(name)
+        if current is None:
+            summaries[name] = dict(entry)
+            continue
+        current['calls'] += entry['calls']
+        current['total_ms'] = round(current['total_ms'] + entry['total_ms'], 3)
+        for percent in INSTRUMENTATION_PERCENTILES:
+            current[f'p{percent}_ms'] = max(current[f'p{percent}_ms'], entry[f'p{percent}_ms'])
+    return summaries
+
+
+def report(logger):
+    """
+    Log summary of all calls of instrumented functions
+    """
+    for name, counter in sorted(counters.items(), key=lambda item: item[1].total, reverse=True):
+        if counter.calls:
+            result = summary(counter.calls, counter.total, counter.histogram)
+            logger.info(f'Instrumentation {name}: {result["calls"]} calls, total {result["total_ms"]}ms, '
+                        f'p50 {result["p50_ms"]}ms, p99 {result["p99_ms"]}ms, max {round(counter.max * 1000, 3)}ms')
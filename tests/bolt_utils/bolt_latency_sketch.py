@@ -0,0 +1,196 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import math
+import os
+import struct
+
+# envs
+LATENCY_SKETCH = os.getenv('BOLT_LATENCY_SKETCH', 'true').lower() in ('1', 'true', 'yes')
+LATENCY_SKETCH_ACCURACY = float(os.getenv('BOLT_LATENCY_SKETCH_ACCURACY', '0.01'))
+
+LATENCY_SKETCH_PERCENTILES = (50, 90, 95, 99)
+# values below this one (in ms) are counted as zeros
+MIN_INDEXABLE_VALUE = 1e-3
+# limit of samples back-filled for single slow response
+MAX_BACKFILLED_SAMPLES = 10000
+
+_HEADER = struct.Struct('<dQddd')
+
+
+def _write_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class LatencySketch(object):
+    """
+    Mergeable log-bucketed sketch of latencies (DDSketch). Every quantile is returned with relative error
+    not higher than `relative_accuracy`, memory depends only on range of values, not on their number.
+    """
+    __slots__ = ('gamma', 'log_gamma', 'bins', 'zero_count', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, relative_accuracy=LATENCY_SKETCH_ACCURACY, gamma=None):
+        self.gamma = gamma or (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def add_with_expected_interval(self, value, expected_interval):
+        """
+        Add value and back-fill samples which were not sent while waiting for it (coordinated omission correction,
+        the same as in HdrHistogram): value - interval, value - 2 * interval, ... down to expected interval.
+        Back-filled samples are counted per bucket, every bucket gets all samples from its range at once.
+        """
+        self.add(value)
+        if expected_interval <= 0:
+            return
+        # samples value - j * interval for j in 1..missing
+        missing = min(int(value / expected_interval) - 1, MAX_BACKFILLED_SAMPLES)
+        if missing <= 0:
+            return
+        j = 1
+        while j <= missing:
+            missing_value = value - j * expected_interval
+            if missing_value < MIN_INDEXABLE_VALUE:
+                # all remaining (lower) samples are zeros
+                self.zero_count += missing - j + 1
+                break
+            key = math.ceil(math.log(missing_value) / self.log_gamma)
+            # the last sample above lower bound of bucket
+            last = min(missing, max(j, math.ceil((value - self.gamma ** (key - 1)) / expected_interval) - 1))
+            self.bins[key] = self.bins.get(key, 0) + last - j + 1
+            j = last + 1
+        self.count += missing
+        self.sum += missing * value - expected_interval * missing * (missing + 1) / 2
+        self.min = min(self.min, value - missing * expected_interval)
+
+    def merge(self, other):
+        if abs(self.gamma - other.gamma) > 1e-12:
+            raise ValueError('Cannot merge sketches with different accuracy')
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, percentiles=LATENCY_SKETCH_PERCENTILES):
+        """
+        Return {percentile: value} for all percentiles (0 - 100) in single pass over buckets
+        """
+        result = dict.fromkeys(percentiles, 0)
+        if not self.count:
+            return result
+        ordered = sorted(percentiles)
+        ranks = [percent / 100 * (self.count - 1) for percent in ordered]
+        index = 0
+        processed_count = self.zero_count
+        while index < len(ordered) and processed_count > ranks[index]:
+            index += 1
+        for key in sorted(self.bins):
+            if index == len(ordered):
+                break
+            processed_count += self.bins[key]
+            value = min(max(2 * self.gamma ** key / (self.gamma + 1), self.min), self.max)
+            while index < len(ordered) and processed_count > ranks[index]:
+                result[ordered[index]] = round(value, 2)
+                index += 1
+        return result
+
+    def to_bytes(self):
+        buffer = bytearray(_HEADER.pack(self.gamma, self.zero_count, self.sum, self.min, self.max))
+        _write_varint(buffer, len(self.bins))
+        previous_key = 0
+        for key in sorted(self.bins):
+            delta = key - previous_key
+            _write_varint(buffer, (delta << 1) ^ (delta >> 63))  # zigzag encoding for negative keys
+            _write_varint(buffer, self.bins[key])
+            previous_key = key
+        return bytes(buffer)
+
+    @classmethod
+    def from_bytes(cls, data):
+        gamma, zero_count, total, minimum, maximum = _HEADER.unpack_from(data)
+        sketch = cls(gamma=gamma)
+        sketch.zero_count = zero_count
+        sketch.sum = total
+        sketch.min = minimum
+        sketch.max = maximum
+        number_of_bins, offset = _read_varint(data, _HEADER.size)
+        key = 0
+        for _ in range(number_of_bins):
+            delta, offset = _read_varint(data, offset)
+            key += (delta >> 1) ^ -(delta & 1)
+            count, offset = _read_varint(data, offset)
+            sketch.bins[key] = count
+        sketch.count = zero_count + sum(sketch.bins.values())
+        return sketch
+
+
+def serialize_sketches(sketches):
+    """
+    {(method, name): sketch} -> [[method, name, bytes], ...]
+    """
+    return [[method, name, sketch.to_bytes()] for (method, name), sketch in sketches.items()]
+
+
+def merge_serialized_sketches(sketches, serialized):
+    """
+    Merge [[method, name, bytes], ...] into {(method, name): sketch}
+    """
+    for method, name, sketch_data in serialized:
+        sketch = LatencySketch.from_bytes(sketch_data)
+        if (method, name) in sketches:
+            sketches[(method, name)].merge(sketch)
+        else:
+            sketches[(method, name)] = sketch
+    return sketches
@@ -17,19 +17,122 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import atexit
+import json
 import logging
+import logging.handlers
+import os
 import time
 
 from functools import wraps
 
+from gevent import monkey
+
+# envs
+LOG_LEVEL = os.getenv('BOLT_LOG_LEVEL', 'INFO').upper()
+LOG_JSON = os.getenv('BOLT_LOG_JSON', 'false').lower() in ('1', 'true', 'yes')
+LOG_RATE_LIMIT_SECONDS = float(os.getenv('BOLT_LOG_RATE_LIMIT_SECONDS', '5'))  # 0 disables rate limiting
+
+# locust patches threading and queue with gevent, listener runs on native thread with native queue and locks,
+# so blocking writes of logs do not block the hub (the same objects are used when modules are not patched)
+_start_new_thread, _allocate_lock, _RLock = monkey.get_original(
+    '_thread', ['start_new_thread', 'allocate_lock', 'RLock']
+)
+_log_queue = monkey.get_original('queue', 'SimpleQueue')()
+_log_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as compact JSON lines (tracebacks are already merged into message by QueueHandler)
+    """
+
+    def format(self, record):
+        return json.dumps({
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'module': record.module,
+            'message': record.getMessage(),
+        }, separators=(',', ':'))
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop the same message repeated by logger within `interval` seconds.
+    Number of dropped messages is added to the next message which passes the filter.
+    """
+    max_tracked_messages = 1000
+
+    def __init__(self, interval=LOG_RATE_LIMIT_SECONDS):
+        super().__init__()
+        self.interval = interval
+        self._messages = {}
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        # message can be any object (e.g. list of arguments)
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        last_time, suppressed = self._messages.get(key, (0, 0))
+        if now - last_time < self.interval:
+            self._messages[key] = (last_time, suppressed + 1)
+            return False
+        if len(self._messages) >= self.max_tracked_messages:
+            self._messages.clear()
+        self._messages[key] = (now, 0)
+        if suppressed:
+            record.msg = f'{record.msg} ({suppressed} similar messages suppressed)'
+        return True
+
+
+class NativeThreadQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener which handles records on native thread also when threading is patched by gevent
+    """
+
+    def start(self):
+        self._finished = _allocate_lock()
+        self._finished.acquire()
+        _start_new_thread(self._run, ())
+
+    def _run(self):
+        try:
+            self._monitor()
+        finally:
+            self._finished.release()
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._finished.acquire()
+
+
+def _start_log_listener():
+    global _log_listener
+    if _log_listener is None:
+        handler = logging.StreamHandler()
+        if LOG_JSON:
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s'))
+        # handler is used only by listener thread
+        handler.lock = _RLock()
+        _log_listener = NativeThreadQueueListener(_log_queue, handler, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+
 
 def setup_custom_logger(name=None):
-    formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
+    """
+    Logger which hands records over to background listener, so writing logs never blocks caller
+    """
+    _start_log_listener()
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    if not any(isinstance(h, logging.handlers.QueueHandler) for h in logger.handlers):
+        handler = logging.handlers.QueueHandler(_log_queue)
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
     logger.propagate = False
     return logger
 
@@ -41,6 +144,8 @@ def log_time_execution(logger):
             start = time.time()
             result = func(*args, **kwargs)
             end = time.time()
+            if not logger.isEnabledFor(logging.INFO):
+                return result
             gql_summary = []
             if type(result) is dict:
                 for k, v in result.items():
@@ -48,7 +153,7 @@ def log_time_execution(logger):
                         affected_rows = v.get('affected_rows', None)
                         if affected_rows is not None:
                             gql_summary.append(f'affected {affected_rows} rows in {k}')
-            logger.info(f'Function {func.__name__} ran in {round(end - start, 2)}s {", ".join(gql_summary)}.')
+            logger.info(f'Function {func.__name__} ran in %ss %s.', round(end - start, 2), ', '.join(gql_summary))
             return result
         return wrapper
     return decorator
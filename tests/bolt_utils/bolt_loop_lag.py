@@ -0,0 +1,100 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import time
+
+import gevent
+
+# envs
+LOOP_LAG_MONITOR = os.getenv('BOLT_LOOP_LAG_MONITOR', 'false').lower() in ('1', 'true', 'yes')
+LOOP_LAG_INTERVAL_MS = int(os.getenv('BOLT_LOOP_LAG_INTERVAL_MS', '100'))
+LOOP_LAG_WARNING_MS = int(os.getenv('BOLT_LOOP_LAG_WARNING_MS', '500'))
+
+LOOP_LAG_PERCENTILES = (50, 90, 99)
+
+
+def _rounded_lag(lag_ms):
+    # the same rounding as for response times in locust, keeps histogram small
+    if lag_ms < 100:
+        return round(lag_ms)
+    elif lag_ms < 1000:
+        return round(lag_ms, -1)
+    return round(lag_ms, -2)
+
+
+class LoopLagMonitor(object):
+    """
+    Greenlet which sleeps for fixed interval and measures how late it was woken up by gevent hub.
+    Overshoots are kept in histogram {lag_ms: count} until next snapshot.
+    `on_warning` is called with lag in ms when lag exceeds warning threshold (once until next snapshot).
+    """
+
+    def __init__(self, on_warning=None, interval_ms=LOOP_LAG_INTERVAL_MS, warning_ms=LOOP_LAG_WARNING_MS):
+        self.on_warning = on_warning
+        self.interval = interval_ms / 1000
+        self.warning_ms = warning_ms
+        self.histogram = {}
+        self.max_lag = 0
+        self.warned = False
+        self._greenlet = None
+
+    def record(self, lag_ms):
+        bucket = _rounded_lag(lag_ms)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        if lag_ms > self.max_lag:
+            self.max_lag = lag_ms
+        if lag_ms > self.warning_ms and not self.warned:
+            self.warned = True
+            if self.on_warning is not None:
+                self.on_warning(round(lag_ms, 2))
+
+    def snapshot(self):
+        """
+        Return lag percentiles in ms since previous snapshot and reset histogram
+        """
+        histogram, self.histogram = self.histogram, {}
+        max_lag, self.max_lag = self.max_lag, 0
+        self.warned = False
+        count = sum(histogram.values())
+        result = {'count': count, 'max': round(max_lag, 2)}
+        processed = 0
+        buckets = iter(sorted(histogram.items()))
+        bucket = 0
+        for percent in LOOP_LAG_PERCENTILES:
+            while processed < count * percent / 100:
+                bucket, bucket_count = next(buckets)
+                processed += bucket_count
+            result[f'p{percent}'] = bucket
+        return result
+
+    def _loop(self):
+        while True:
+            start = time.perf_counter()
+            gevent.sleep(self.interval)
+            self.record(max(time.perf_counter() - start - self.interval, 0) * 1000)
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._loop)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
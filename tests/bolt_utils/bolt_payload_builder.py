@@ -0,0 +1,125 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+import json
+
+from bolt_utils.bolt_transport import RawJSON
+
+# columns of execution_requests rows which are different for every endpoint
+REQUESTS_COLUMNS = (
+    'identifier', 'idempotency_key', 'method', 'name', 'num_requests', 'num_failures', 'average_response_time',
+    'min_response_time', 'max_response_time', 'total_content_length', 'median_response_time',
+    'requests_per_second', 'successes_per_tick',
+)
+STRING_COLUMNS = frozenset(('identifier', 'idempotency_key', 'method', 'name'))
+IDENTIFIER_CACHE_SIZE = 4096
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+_identifiers = {}
+
+
+def identifier(parts: list):
+    # stable between processes (unlike built-in hash), so the same data always gets the same identifier
+    key = ' '.join(map(lambda x: x.strip(), parts)).lower().encode()
+    return str(int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big') >> 1)
+
+
+def endpoint_identifier(method, name):
+    """
+    Cached identifier of endpoint (the same endpoints are reported in every tick)
+    """
+    try:
+        return _identifiers[(method, name)]
+    except KeyError:
+        if len(_identifiers) >= IDENTIFIER_CACHE_SIZE:
+            _identifiers.clear()
+        value = _identifiers[(method, name)] = identifier([method, name])
+        return value
+
+
+class RequestsPayloadBuilder(object):
+    """
+    Gathers endpoint stats of single tick into columns and serializes them straight into JSON array of
+    execution_requests rows. Values which are the same for every row (timestamp, average content size) are
+    encoded only once. Reports passed to builder are not modified. Rows get idempotency keys only with `tick_key`.
+    """
+    def __init__(self, tick_key, timestamp, average_content_size):
+        self.tick_key = tick_key
+        self.constants = {'timestamp': timestamp, 'average_content_size': average_content_size}
+        self.column_names = REQUESTS_COLUMNS if tick_key is not None else tuple(
+            column for column in REQUESTS_COLUMNS if column != 'idempotency_key'
+        )
+        self.columns = {column: [] for column in self.column_names}
+
+    def __len__(self):
+        return len(self.columns['identifier'])
+
+    def add_endpoints(self, endpoints, median_response_time, requests_per_second):
+        """
+        Add endpoints of single worker report (list of locust serialized StatsEntry)
+        """
+        columns = self.columns
+        for endpoint in endpoints:
+            method, name, num_requests = endpoint['method'], endpoint['name'], endpoint['num_requests']
+            if self.tick_key is not None:
+                columns['idempotency_key'].append(identifier([*self.tick_key, 'requests', str(len(self))]))
+            columns['identifier'].append(endpoint_identifier(method, name))
+            columns['method'].append(method)
+            columns['name'].append(name)
+            columns['num_requests'].append(num_requests)
+            columns['num_failures'].append(endpoint['num_failures'])
+            columns['average_response_time'].append(
+                round(endpoint['total_response_time'] / num_requests) if num_requests else 0
+            )
+            columns['min_response_time'].append(endpoint['min_response_time'])
+            columns['max_response_time'].append(endpoint['max_response_time'])
+            columns['total_content_length'].append(endpoint['total_content_length'])
+            columns['median_response_time'].append(median_response_time.get(name, 0))
+            columns['requests_per_second'].append(requests_per_second.get(name, 0))
+            columns['successes_per_tick'].append(
+                num_requests - (endpoint['num_failures'] + endpoint['num_none_requests'])
+            )
+
+    def to_json(self):
+        """
+        Serialize rows into JSON array
+        """
+        return RawJSON('[' + ','.join(self.encoded_rows()) + ']')
+
+    def encoded_rows(self):
+        """
+        Serialize every row into JSON object. Every numeric column is encoded with single `json` call, then values
+        are put into row template.
+        """
+        if not len(self):
+            return []
+        encoded_columns = []
+        for column in self.column_names:
+            values = self.columns[column]
+            if column in STRING_COLUMNS:
+                encoded_columns.append(list(map(_dumps, values)))
+            else:
+                # numbers and nulls do not contain commas
+                encoded_columns.append(_dumps(values)[1:-1].split(','))
+        constants = ''.join(
+            f',{_dumps(key)}:{_dumps(value).replace("%", "%%")}' for key, value in self.constants.items()
+        )
+        template = '{' + ','.join(f'"{column}":%s' for column in self.column_names) + constants + '}'
+        return list(map(template.__mod__, zip(*encoded_columns)))
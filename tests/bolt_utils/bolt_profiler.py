@@ -0,0 +1,101 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import cProfile
+import os
+import signal
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+NFS_MOUNT = os.getenv('BOLT_NFS_MOUNT_1')
+PROFILE_DIR = os.getenv('BOLT_PROFILE_DIR') or NFS_MOUNT or tempfile.gettempdir()
+PROFILE_ON_START = os.getenv('BOLT_PROFILE_ON_START', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_DURATION = int(os.getenv('BOLT_PROFILE_DURATION', '30'))
+PROFILE_TRACEMALLOC = os.getenv('BOLT_PROFILE_TRACEMALLOC', 'false').lower() in ('1', 'true', 'yes')
+
+logger = setup_custom_logger(__name__)
+
+
+class ProfilerCapture(object):
+    """
+    Capture cProfile stats (and optionally tracemalloc snapshots) for bounded window of time.
+    Capture can be started by SIGUSR1 signal during test, results are written to `directory`.
+    """
+
+    def __init__(self, name, directory=PROFILE_DIR, duration=PROFILE_DURATION, trace_memory=PROFILE_TRACEMALLOC):
+        self.name = name
+        self.directory = directory
+        self.duration = duration
+        self.trace_memory = trace_memory
+        self.profile = None
+        self._memory_snapshot = None
+        self._path_prefix = None
+
+    @property
+    def is_running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.is_running:
+            logger.info('Profiler is already running. Ignored')
+            return
+        self._path_prefix = os.path.join(
+            self.directory, f'bolt_profile_{self.name}_{os.getpid()}_{time.strftime("%Y%m%d%H%M%S")}'
+        )
+        logger.info(f'Starting profiler for {self.duration}s. Output: {self._path_prefix}.*')
+        if self.trace_memory:
+            tracemalloc.start()
+            self._memory_snapshot = tracemalloc.take_snapshot()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        # under gevent monkey patching timer runs as greenlet in the same thread as profiled code
+        timer = threading.Timer(self.duration, self.stop)
+        timer.daemon = True
+        timer.start()
+
+    def stop(self):
+        if not self.is_running:
+            return
+        profile, self.profile = self.profile, None
+        profile.disable()
+        try:
+            profile.dump_stats(f'{self._path_prefix}.prof')
+            if self.trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                snapshot.dump(f'{self._path_prefix}.tracemalloc')
+                for stat in snapshot.compare_to(self._memory_snapshot, 'lineno')[:10]:
+                    logger.info(f'Profiler memory: {stat}')
+        except OSError as ex:
+            logger.exception(f'Cannot save profiler results | {ex}')
+        else:
+            logger.info(f'Profiler results saved to {self._path_prefix}.*')
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+            self._memory_snapshot = None
+
+    def install(self, signum=signal.SIGUSR1):
+        signal.signal(signum, lambda signo, stack_frame: self.start())
+        if PROFILE_ON_START:
+            self.start()
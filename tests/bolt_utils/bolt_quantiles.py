@@ -0,0 +1,75 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+# envs
+PERCENTILES = [float(p) for p in os.getenv('BOLT_PERCENTILES', '50,66,75,80,90,95,98,99,100').split(',')]
+DISTRIBUTION_SNAPSHOT_INTERVAL = int(os.getenv('BOLT_DISTRIBUTION_SNAPSHOT_INTERVAL', '0'))  # 0 - only at the end
+
+# percentiles with columns in execution_distribution, other configured ones are saved only in distribution snapshots
+DISTRIBUTION_PERCENTILES = (50, 66, 75, 80, 90, 95, 98, 99, 100)
+
+
+def percentile_column(percent):
+    """
+    Column name for percentile: 99 -> 'p99', 99.9 -> 'p99_9'
+    """
+    return f'p{percent:g}'.replace('.', '_')
+
+
+def histogram_percentiles(response_times, num_requests, percentiles=PERCENTILES):
+    """
+    Calculate all percentiles (0 - 100) from locust histogram {response_time: count} in single pass over sorted
+    response times. Returns the same values as locust `calculate_response_time_percentile` for every percentile.
+    """
+    # the highest percentile is found first when walking from the highest response time
+    ordered = sorted(percentiles, reverse=True)
+    # the same expression as in locust, float result differs for some percentiles (e.g. 29) with other order
+    thresholds = [int(num_requests * (percent / 100)) for percent in ordered]
+    result = dict.fromkeys(percentiles, 0)
+    index = 0
+    processed_count = 0
+    for response_time in sorted(response_times, reverse=True):
+        processed_count += response_times[response_time]
+        while index < len(ordered) and num_requests - processed_count <= thresholds[index]:
+            result[ordered[index]] = response_time
+            index += 1
+        if index == len(ordered):
+            break
+    return result
+
+
+def histogram_median(response_times):
+    """
+    Median (the same as statistics.median) of values from histogram {value: count} without expanding it to list
+    """
+    total = sum(response_times.values())
+    if not total:
+        return 0
+    # indexes of middle values in sorted list of all values
+    lower_index, upper_index = (total - 1) // 2, total // 2
+    lower = None
+    processed_count = 0
+    for value in sorted(response_times):
+        processed_count += response_times[value]
+        if lower is None and processed_count > lower_index:
+            lower = value
+        if processed_count > upper_index:
+            return lower if lower_index == upper_index else (lower + value) / 2
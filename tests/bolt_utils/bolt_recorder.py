@@ -0,0 +1,115 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import threading
+import time
+
+import msgpack
+
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+# directory for event logs, events are recorded only when it is set
+RECORD_DIR = os.getenv('BOLT_RECORD_DIR')
+
+WORKER_REPORT = 'worker_report'
+REQUEST = 'request'
+TEST_INIT = 'test_init'
+TEST_START = 'test_start'
+
+logger = setup_custom_logger(__name__)
+
+
+class EventRecorder(object):
+    """
+    Writes events (test init and start, worker reports, requests) with their timestamps to msgpack log: stream of
+    [timestamp, event type, event arguments] arrays.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'ab')
+        # values unknown for msgpack (e.g. exceptions) are recorded as strings
+        self._packer = msgpack.Packer(use_bin_type=True, default=str)
+        self._lock = threading.Lock()
+
+    def record(self, event_type, **kwargs):
+        data = self._packer.pack([time.time(), event_type, kwargs])
+        with self._lock:
+            self._file.write(data)
+            self.events += 1
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                logger.info(f'Recorded {self.events} events in {self.path}')
+
+
+def recorder_for(name):
+    """
+    Recorder writing to `RECORD_DIR` or None when recording is disabled
+    """
+    if not RECORD_DIR:
+        return None
+    return EventRecorder(os.path.join(RECORD_DIR, f'bolt_events_{name}_{os.getpid()}.msgpack'))
+
+
+def read_events(path):
+    with open(path, 'rb') as file:
+        yield from msgpack.Unpacker(file, raw=False, strict_map_key=False)
+
+
+class EventReplayer(object):
+    """
+    Feeds recorded events to listeners ({event type: function}) at original speed multiplied by `speed`
+    (0 - as fast as possible). `clock` returns recorded time of current event, so time based aggregation
+    gives the same results with any speed.
+    """
+
+    def __init__(self, path, listeners, speed=1.0):
+        self.path = path
+        self.listeners = listeners
+        self.speed = speed
+        self.current_time = None
+
+    def clock(self):
+        return self.current_time if self.current_time is not None else time.time()
+
+    def replay(self):
+        started = time.monotonic()
+        first_timestamp = None
+        events = 0
+        for timestamp, event_type, kwargs in read_events(self.path):
+            listener = self.listeners.get(event_type)
+            if listener is None:
+                continue
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            if self.speed > 0:
+                delay = (timestamp - first_timestamp) / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            self.current_time = timestamp
+            listener(**kwargs)
+            events += 1
+        return events
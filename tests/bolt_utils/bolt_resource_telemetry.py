@@ -0,0 +1,94 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import time
+
+import gevent
+import psutil
+
+# envs
+RESOURCE_TELEMETRY_INTERVAL = float(os.getenv('BOLT_RESOURCE_TELEMETRY_INTERVAL', '1'))  # 0 disables telemetry
+
+RESOURCE_FIELDS = ('cpu_percent', 'rss', 'loop_lag_ms', 'users')
+
+
+class ResourceSampler(object):
+    """
+    Periodically samples CPU, memory, loop lag and users of current process in background greenlet.
+    Every sample is passed to `send` as compact list [timestamp, cpu_percent, rss, loop_lag_ms, users].
+    """
+
+    def __init__(self, send, user_count, interval=RESOURCE_TELEMETRY_INTERVAL):
+        self.send = send
+        self.user_count = user_count
+        self.interval = interval
+        self.process = psutil.Process()
+        self._greenlet = None
+
+    def sample(self, loop_lag):
+        return [
+            round(time.time(), 3),
+            self.process.cpu_percent(),
+            self.process.memory_info().rss,
+            round(loop_lag * 1000, 2),
+            self.user_count(),
+        ]
+
+    def _loop(self):
+        self.process.cpu_percent()  # first call only starts measuring
+        while True:
+            expected = time.monotonic() + self.interval
+            gevent.sleep(self.interval)
+            loop_lag = max(time.monotonic() - expected, 0)
+            self.send(self.sample(loop_lag))
+
+    def start(self):
+        if self.interval > 0 and self._greenlet is None:
+            self._greenlet = gevent.spawn(self._loop)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+
+class ResourceAggregator(object):
+    """
+    Collects samples from ResourceSampler of every node and aggregates them per tick
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, node_id, sample):
+        self.samples.setdefault(node_id, []).append(sample)
+
+    def flush(self):
+        """
+        Return {node_id: {field: [min, avg, max]}} for samples collected since previous flush
+        """
+        samples, self.samples = self.samples, {}
+        aggregated = {}
+        for node_id, node_samples in samples.items():
+            aggregated[node_id] = {}
+            for index, field in enumerate(RESOURCE_FIELDS, start=1):
+                values = [s[index] for s in node_samples]
+                aggregated[node_id][field] = [min(values), round(sum(values) / len(values), 2), max(values)]
+        return aggregated
@@ -0,0 +1,89 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import heapq
+import itertools
+import os
+
+# envs
+SLOWEST_REQUESTS = int(os.getenv('BOLT_SLOWEST_REQUESTS', '5'))
+
+# types of context values which are kept in exemplars
+CONTEXT_VALUE_TYPES = (str, int, float, bool)
+
+
+def request_exemplar(start_time, response_time, response_length, response, context, exception, url):
+    """
+    Build exemplar of single request from `request` event arguments
+    """
+    return {
+        'timestamp': start_time,
+        'response_time': response_time,
+        'response_length': response_length,
+        'status_code': getattr(response, 'status_code', None),
+        'exception': str(exception) if exception is not None else None,
+        'url': url,
+        'context': {
+            key: value for key, value in (context or {}).items() if isinstance(value, CONTEXT_VALUE_TYPES)
+        },
+    }
+
+
+class SlowestRequests(object):
+    """
+    Keeps N slowest requests for every endpoint in min-heaps, so adding request costs O(log N) and memory is fixed.
+    Exemplar is built by `exemplar_factory` only when request goes into heap.
+    """
+    def __init__(self, size=SLOWEST_REQUESTS):
+        self.size = size
+        self.heaps = {}
+        # tie breaker for requests with equal response time (exemplars are not comparable)
+        self.counter = itertools.count()
+
+    def add(self, key, response_time, exemplar_factory):
+        heap = self.heaps.get(key)
+        if heap is None:
+            heap = self.heaps[key] = []
+        if len(heap) < self.size:
+            heapq.heappush(heap, (response_time, next(self.counter), exemplar_factory()))
+        elif response_time > heap[0][0]:
+            heapq.heapreplace(heap, (response_time, next(self.counter), exemplar_factory()))
+
+    def merge(self, serialized):
+        """
+        Merge [[method, name, [exemplar, ...]], ...] received from other node
+        """
+        for method, name, exemplars in serialized:
+            for exemplar in exemplars:
+                self.add((method, name), exemplar['response_time'], lambda: exemplar)
+
+    def serialize(self):
+        """
+        Return [[method, name, [exemplar, ...]], ...] with exemplars sorted from the slowest one
+        """
+        return [
+            [method, name, [exemplar for _, _, exemplar in sorted(heap, reverse=True)]]
+            for (method, name), heap in self.heaps.items()
+        ]
+
+    def clear(self):
+        self.heaps = {}
+
+    def __bool__(self):
+        return bool(self.heaps)
@@ -17,11 +17,105 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import gzip
+import hashlib
+import json
+import os
+import zlib
+
 import requests
 
 from gql.transport.requests import RequestsHTTPTransport
 from graphql.execution import ExecutionResult
+from graphql.language.ast import OperationType
 from graphql.language.printer import print_ast
+from graphql.utilities import strip_ignored_characters
+
+from bolt_utils.bolt_circuit_breaker import CircuitBreaker
+from bolt_utils.bolt_exceptions import OfflineModeError
+from bolt_utils.bolt_logger import setup_custom_logger
+
+# envs
+# 'gzip', 'deflate' or empty for uncompressed request bodies
+GRAPHQL_COMPRESSION = os.getenv('BOLT_GRAPHQL_COMPRESSION', '')
+GRAPHQL_COMPRESSION_THRESHOLD = int(os.getenv('BOLT_GRAPHQL_COMPRESSION_THRESHOLD', '1024'))
+# 'full' - printed document, 'minified' - document without ignored characters,
+# 'persisted' - sha256 hash of minified document (automatic persisted queries protocol)
+GRAPHQL_QUERY_MODE = os.getenv('BOLT_GRAPHQL_QUERY_MODE', 'full')
+
+QUERY_CACHE_SIZE = 256
+PERSISTED_QUERY_NOT_FOUND = 'PersistedQueryNotFound'
+
+# mutations of test results which can be archived and uploaded later, status updates are never archived
+# because their upload would overwrite current status of execution
+RESULT_MUTATIONS = frozenset((
+    'insert_execution_requests', 'insert_execution_errors', 'insert_execution_metrics_data',
+    'insert_execution_distribution', 'insert_execution_request_totals', 'insert_result_error',
+    'insert_result_aggregate',
+))
+
+logger = setup_custom_logger(__name__)
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+COMPRESSORS = {
+    'gzip': lambda body: gzip.compress(body, compresslevel=6),
+    'deflate': lambda body: zlib.compress(body, 6),
+}
+
+
+class RawJSON(str):
+    """
+    Variable value which is already serialized to JSON, it is put into request body as it is
+    """
+
+
+def encode_variables(variables):
+    """
+    Encode variables as compact JSON, variables of `RawJSON` type are not encoded again
+    """
+    if not any(isinstance(value, RawJSON) for value in variables.values()):
+        return _dumps(variables)
+    return '{' + ','.join(
+        f'{_dumps(key)}:{value if isinstance(value, RawJSON) else _dumps(value)}' for key, value in variables.items()
+    ) + '}'
+
+
+def encode_payload(payload):
+    """
+    Encode payload as compact JSON, variables of `RawJSON` type are not encoded again
+    """
+    variables = payload.get('variables') or {}
+    if not any(isinstance(value, RawJSON) for value in variables.values()):
+        return _dumps(payload)
+    encoded_payload = ''.join(
+        f',{_dumps(key)}:{_dumps(value)}' for key, value in payload.items() if key != 'variables'
+    )
+    return f'{{"variables":{encode_variables(variables)}{encoded_payload}}}'
+
+
+def operation_name(document):
+    """
+    Name of operation or name of its first root field for anonymous operations
+    """
+    definition = document.definitions[0]
+    if getattr(definition, 'name', None) is not None:
+        return definition.name.value
+    return definition.selection_set.selections[0].name.value
+
+
+def root_fields(document):
+    return ','.join(field.name.value for field in document.definitions[0].selection_set.selections)
+
+
+def is_mutation(document):
+    return getattr(document.definitions[0], 'operation', None) == OperationType.MUTATION
+
+
+def is_result_mutation(document):
+    return is_mutation(document) and all(
+        field.name.value in RESULT_MUTATIONS for field in document.definitions[0].selection_set.selections
+    )
 
 
 class WrappedTransport(RequestsHTTPTransport):
@@ -29,31 +123,140 @@ class WrappedTransport(RequestsHTTPTransport):
 
     def __init__(self, *args, **kwargs):
         self.no_keep_alive = kwargs.pop('no_keep_alive', False)
+        self.compression = kwargs.pop('compression', GRAPHQL_COMPRESSION)
+        self.compression_threshold = kwargs.pop('compression_threshold', GRAPHQL_COMPRESSION_THRESHOLD)
+        self.query_mode = kwargs.pop('query_mode', GRAPHQL_QUERY_MODE)
         super().__init__(*args, **kwargs)
+        self.circuit_breaker = CircuitBreaker(name=self.url)
+        # printed query -> (query sent to API, sha256 hash)
+        self.queries = {}
+        # hashes of queries already registered in API (for 'persisted' mode)
+        self.persisted_queries = set()
+        # operation -> [calls, bytes of payload, bytes sent]
+        self.traffic = {}
+        # OperationCoalescer which collects operations of scheduled writes
+        self.coalescer = None
+        # ResultsArchive for mutations which are not sent (offline mode or API outage)
+        self.archive = None
 
         if self.no_keep_alive:
             self.headers['Connection'] = 'close'
 
-    def execute(self, document, variable_values=None, timeout=None):
-        query_str = print_ast(document)
-        payload = {
-            'query': query_str,
-            'variables': variable_values or {}
+    def prepare_query(self, query_str):
+        try:
+            return self.queries[query_str]
+        except KeyError:
+            pass
+        if len(self.queries) >= QUERY_CACHE_SIZE:
+            self.queries.clear()
+        query = query_str if self.query_mode == 'full' else strip_ignored_characters(query_str)
+        prepared = self.queries[query_str] = (query, hashlib.sha256(query.encode('utf-8')).hexdigest())
+        return prepared
+
+    def prepare_body(self, payload, operation):
+        """
+        Encode payload as compact JSON and compress it above threshold. Returns body and additional headers.
+        """
+        body = encode_payload(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        raw_size = len(body)
+        compressor = COMPRESSORS.get(self.compression)
+        if compressor is not None and raw_size >= self.compression_threshold:
+            body = compressor(body)
+            headers['Content-Encoding'] = self.compression
+        traffic = self.traffic.get(operation)
+        if traffic is None:
+            traffic = self.traffic[operation] = [0, 0, 0]
+        traffic[0] += 1
+        traffic[1] += raw_size
+        traffic[2] += len(body)
+        return body, headers
+
+    def traffic_stats(self):
+        """
+        Number of calls, bytes of JSON payload and bytes sent per operation since previous call
+        """
+        traffic, self.traffic = self.traffic, {}
+        return {
+            operation: {'calls': calls, 'payload_bytes': payload_bytes, 'sent_bytes': sent_bytes}
+            for operation, (calls, payload_bytes, sent_bytes) in traffic.items()
         }
 
-        data_key = 'json' if self.use_json else 'data'
+    def post(self, post_args):
+        # fail fast with CircuitOpenError when API is not available
+        self.circuit_breaker.before_call()
+        try:
+            request = requests.post(self.url, **post_args)
+            if request.status_code >= 500:
+                request.raise_for_status()
+        except requests.RequestException:
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        result = request.json()
+        assert 'errors' in result or 'data' in result, 'Received non-compatible response "{}"'.format(result)
+        return result
+
+    def archive_operation(self, document, variable_values):
+        self.archive.add(root_fields(document), print_ast(document), encode_variables(variable_values or {}))
+        return ExecutionResult(data=None, errors=None)
+
+    def execute(self, document, variable_values=None, timeout=None):
+        if self.archive is not None and self.archive.offline:
+            if is_result_mutation(document):
+                return self.archive_operation(document, variable_values)
+            if is_mutation(document):
+                # there is no execution to update in offline mode
+                logger.debug(f'Skipped {root_fields(document)} in offline mode')
+                return ExecutionResult(data=None, errors=None)
+            raise OfflineModeError(f'Cannot execute {root_fields(document)}, API is not available in offline mode')
+        if self.archive is not None and self.archive.archiving and is_result_mutation(document):
+            # API was not available until the end of test (see `ResultsArchive.start_outage_archiving`)
+            return self.archive_operation(document, variable_values)
+        if self.coalescer is not None and self.coalescer.is_coalescing():
+            return self.coalescer.submit(document, variable_values)
+        return self.send(document, variable_values, timeout)
+
+    def send(self, document, variable_values=None, timeout=None):
+        query_str = print_ast(document)
         post_args = {
-            'headers': self.headers,
             'auth': self.auth,
             'timeout': timeout or self.default_timeout,
-            data_key: payload
         }
-        request = requests.post(self.url, **post_args)
-        if request.status_code >= 500:
-            request.raise_for_status()
+        if not self.use_json:
+            variables = {
+                key: json.loads(value) if isinstance(value, RawJSON) else value
+                for key, value in (variable_values or {}).items()
+            }
+            result = self.post({
+                **post_args, 'headers': self.headers, 'data': {'query': query_str, 'variables': variables}
+            })
+            return ExecutionResult(errors=result.get('errors'), data=result.get('data'))
+
+        operation = operation_name(document)
+        query, query_hash = self.prepare_query(query_str)
+        payload = {'query': query, 'variables': variable_values or {}}
+        if self.query_mode == 'persisted':
+            payload['extensions'] = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash}}
+            # query text is sent only for registration of unknown query
+            if query_hash in self.persisted_queries:
+                del payload['query']
+        body, headers = self.prepare_body(payload, operation)
+        result = self.post({**post_args, 'headers': {**self.headers, **headers}, 'data': body})
+
+        if 'query' not in payload and any(
+            (error.get('message') == PERSISTED_QUERY_NOT_FOUND or
+             error.get('extensions', {}).get('code') == 'PERSISTED_QUERY_NOT_FOUND')
+            for error in result.get('errors') or ()
+        ):
+            # API lost registered query (e.g. after restart), register it again
+            self.persisted_queries.discard(query_hash)
+            payload['query'] = query
+            body, headers = self.prepare_body(payload, operation)
+            result = self.post({**post_args, 'headers': {**self.headers, **headers}, 'data': body})
+        if self.query_mode == 'persisted' and not result.get('errors'):
+            self.persisted_queries.add(query_hash)
 
-        result = request.json()
-        assert 'errors' in result or 'data' in result, 'Received non-compatible response "{}"'.format(result)
         return ExecutionResult(
             errors=result.get('errors'),
             data=result.get('data')
@@ -0,0 +1,208 @@
+# Copyright (c) 2022 Acaisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import threading
+import time
+
+from collections import deque
+from functools import partial
+
+from bolt_utils.bolt_enums import WriteLane
+from bolt_utils.bolt_exceptions import CircuitOpenError
+from bolt_utils.bolt_logger import setup_custom_logger
+from bolt_utils.bolt_coalescer import COALESCE_MAX_OPERATIONS, COALESCE_WINDOW_MS
+
+# envs (rates are in writes per second, 0 means unlimited)
+WRITE_RATES = {
+    WriteLane.STATUS: float(os.getenv('BOLT_WRITE_RATE_STATUS', '0')),
+    WriteLane.AGGREGATES: float(os.getenv('BOLT_WRITE_RATE_AGGREGATES', '10')),
+    WriteLane.DETAILS: float(os.getenv('BOLT_WRITE_RATE_DETAILS', '10')),
+}
+WRITE_BURST = int(os.getenv('BOLT_WRITE_BURST', '20'))
+WRITE_QUEUE_DEPTH = int(os.getenv('BOLT_WRITE_QUEUE_DEPTH', '100'))
+WRITE_FLUSH_TIMEOUT = int(os.getenv('BOLT_WRITE_FLUSH_TIMEOUT', '120'))
+
+logger = setup_custom_logger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """
+        Seconds until next token is available
+        """
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= 1
+
+
+class WriteJob(object):
+    __slots__ = ('func', 'args', 'kwargs', 'coalesce_key', 'on_shed')
+
+    def __init__(self, func, args, kwargs, coalesce_key=None, on_shed=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce_key = coalesce_key
+        self.on_shed = on_shed
+
+
+class WriteScheduler(object):
+    """
+    Executes writes in background thread by priority of lanes, every lane is limited by its own token bucket.
+    When lane exceeds `max_depth` the oldest write is shed (status lane is never shed). Pending write
+    with the same `coalesce_key` is replaced by the newer one. With `coalescer` writes which are ready within
+    `coalesce_window` are executed together, so their operations are sent in single request.
+    """
+
+    def __init__(self, rates=None, burst=WRITE_BURST, max_depth=WRITE_QUEUE_DEPTH, coalescer=None,
+                 coalesce_window=COALESCE_WINDOW_MS / 1000, coalesce_max=COALESCE_MAX_OPERATIONS):
+        rates = rates or WRITE_RATES
+        self.max_depth = max_depth
+        self.coalescer = coalescer
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
+        self.lanes = {lane: deque() for lane in WriteLane}
+        self.buckets = {lane: TokenBucket(rates.get(lane, 0), burst) for lane in WriteLane}
+        self.shed = {lane: 0 for lane in WriteLane}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._busy = False
+        self._draining = False
+
+    def submit(self, lane, func, *args, coalesce_key=None, on_shed=None, **kwargs):
+        job = WriteJob(func, args, kwargs, coalesce_key, on_shed)
+        shed_job = None
+        with self._condition:
+            queue = self.lanes[lane]
+            if coalesce_key is not None:
+                for index, pending in enumerate(queue):
+                    if pending.coalesce_key == coalesce_key:
+                        queue[index] = job
+                        return
+            if lane != WriteLane.STATUS and len(queue) >= self.max_depth:
+                shed_job = queue.popleft()
+                self.shed[lane] += 1
+            queue.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        if shed_job is not None:
+            logger.warning(f'Write queue {lane.name} is full. Shed write {shed_job.func.__name__}')
+            if shed_job.on_shed is not None:
+                shed_job.on_shed(*shed_job.args, **shed_job.kwargs)
+
+    def _next_job(self):
+        """
+        Return (job, None) for the next job to execute or (None, seconds to wait)
+        """
+        wait = None
+        for lane in WriteLane:
+            if not self.lanes[lane]:
+                continue
+            lane_wait = 0 if self._draining else self.buckets[lane].wait_time()
+            if lane_wait == 0:
+                self.buckets[lane].consume()
+                return self.lanes[lane].popleft(), None
+            wait = lane_wait if wait is None else min(wait, lane_wait)
+        return None, wait
+
+    def _next_batch(self, job):
+        """
+        Collect jobs ready within coalesce window (or all ready jobs when draining) to be executed with `job`
+        """
+        batch = [job]
+        deadline = time.monotonic() + self.coalesce_window
+        while len(batch) < self.coalesce_max:
+            job, wait = self._next_job()
+            if job is not None:
+                batch.append(job)
+                continue
+            remaining = deadline - time.monotonic()
+            if self._draining or remaining <= 0:
+                break
+            self._condition.wait(remaining if wait is None else min(wait, remaining))
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job, wait = self._next_job()
+                while job is None:
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait(wait)
+                    job, wait = self._next_job()
+                self._busy = True
+                batch = [job] if self.coalescer is None else self._next_batch(job)
+            if len(batch) == 1:
+                self._execute(job)
+            else:
+                self.coalescer.run([partial(self._execute, job) for job in batch])
+
+    @staticmethod
+    def _execute(job):
+        try:
+            job.func(*job.args, **job.kwargs)
+        except CircuitOpenError as ex:
+            logger.warning(f'Scheduled write {job.func.__name__} skipped | {ex}')
+        except Exception as ex:
+            logger.exception(f'Scheduled write {job.func.__name__} failed | {ex}')
+
+    def flush(self, timeout=WRITE_FLUSH_TIMEOUT):
+        """
+        Execute all pending writes ignoring rate limits. Return False if they were not finished within timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._draining = True
+            self._condition.notify_all()
+            try:
+                while self._busy or any(self.lanes.values()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self._draining = False
+
+    def depths(self):
+        """
+        Return number of pending and shed writes for every lane
+        """
+        return {lane.name.lower(): {'depth': len(self.lanes[lane]), 'shed': self.shed[lane]} for lane in WriteLane}